@@ -4,13 +4,11 @@ from gym.utils import seeding
 import numpy as np
 from os import path
 from a1_env import A1_env
+from controller_utils import desired_speed_heading
 from spline import Spline
-import matplotlib
-import matplotlib.pyplot as plt
 import torch
 import pdb
 from helper import *
-from a1_learning_hierarchical.motion_imitation.envs.a1_env import A1GymEnv
 
 class A1_controller:
     """
@@ -120,7 +118,94 @@ class A1_controller:
         return action
 
 
+class Batch_a1_controller:
+    """
+    Description:
+        A1_controller for N robots at once, differentiable and without
+        branching on tensor values
+        weights: [5] shared gains or [N, 5] per robot (learn_weights)
+    """
+    def __init__(self, weights=[1, 1, 1, 1, 1]):
+
+        weights = torch.as_tensor(weights, dtype=torch.float)
+
+        #position gain
+        self.k_x = weights[..., 0]
+        self.k_y = weights[..., 1]
+
+        #speed gain
+        self.k_v = weights[..., 2]
+
+        #angle gain
+        self.k_phi = weights[..., 3]
+
+        #anglular speed gain
+        self.k_w = weights[..., 4]
+
+    """
+    @params
+        pos_d, vel_d: [N, 2] desired position and velocity
+        obs: [N, 5] states
+
+    @return
+        action: [N, 4] v_des, w_tilde, a, theta
+    """
+    def control(self, pos_d, vel_d, obs):
+
+        v_des, phi_des = desired_speed_heading(pos_d, vel_d, obs, self.k_x, self.k_y)
+
+        return self.next_action_warm_up(v_des, phi_des, obs)
+
+    """
+    @params
+        curr_time: time at which to evaluate controls
+        spline: Batch_spline with N curves
+        obs: [N, 5] states
+
+    @return
+        action: [N, 4] v_des, w_tilde, a, theta
+        des_pos: [N, 2] desired location
+        act_pos: [N, 3] actual location and heading
+    """
+    def next_action(self, curr_time, spline, obs):
+
+        x_d, y_d = spline.evaluate(curr_time, der=0)
+        x_dot_d, y_dot_d = spline.evaluate(curr_time, der=1)
+
+        pos_d = torch.stack((x_d, y_d), dim=-1)
+        action = self.control(pos_d, torch.stack((x_dot_d, y_dot_d), dim=-1), obs)
+
+        return action, pos_d, obs[..., [0, 1, 3]]
+
+    """
+    @params
+        v_des: [N] or scalar desired speed
+        phi_des: [N] or scalar desired heading
+        obs: [N, 5] states
+
+    @return
+        action: [N, 4] v_des, w_tilde, a, theta
+    """
+    def next_action_warm_up(self, v_des, phi_des, obs):
+
+        v_act = obs[..., 2]
+        phi_act = obs[..., 3]
+        w_act = obs[..., 4]
+
+        a = self.k_v*(v_des - v_act)
+
+        w_tilde = self.k_phi*(phi_des - phi_act)
+
+        theta = self.k_w*(w_tilde - w_act)
+
+        v_des = torch.as_tensor(v_des, dtype=a.dtype).expand(a.shape)
+
+        return torch.stack((v_des, w_tilde, a, theta), dim=-1)
+
+
 if __name__=="__main__":
+    import matplotlib.pyplot as plt
+    from a1_learning_hierarchical.motion_imitation.envs.a1_env import A1GymEnv
 
     horizon = 5
     dt = 0.002
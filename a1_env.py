@@ -87,3 +87,131 @@ class A1_env(gym.Env):
 
     def angle_normalize(self, x):
         return abs(((x + np.pi) % (2 * np.pi)) - np.pi)
+
+
+class Vec_a1_env(gym.Env):
+    """
+    Description:
+        num_envs copies of A1_env stepped together
+        state [N, 5]: x, y, v, phi, w
+        action [N, 4]: v_des, w_tilde, a, theta as returned by the A1 controller
+        v0, phi0 are scalars or per robot [N]
+        Buffers are reused the way Vec_dubins_env reuses them, so stepping allocates
+        nothing. An observation is overwritten two steps later. done, costs and the
+        curr_time info are the same tensors on every step
+    """
+    metadata = {"render.modes": ["human", "rgb_array"], "video.frames_per_second": 30}
+
+    def __init__(self, num_envs, total_time = 10, dt=0.01, v0=0, phi0=0):
+
+        max_state = np.array([100, 100, 100, 100, 100])
+        max_input = np.array([10, 10, 10, 10])
+        self.action_space = spaces.Box(low=-np.tile(max_input, (num_envs, 1)), high=np.tile(max_input, (num_envs, 1)), shape=(num_envs, 4), dtype=np.float32)
+        self.observation_space = spaces.Box(low=-np.tile(max_state, (num_envs, 1)), high=np.tile(max_state, (num_envs, 1)), shape=(num_envs, 5), dtype=np.float32)
+
+        self.num_envs = num_envs
+        self.num_steps = total_time // dt
+        self.total_time = total_time
+        self.dt = dt
+        self.v0 = np.broadcast_to(np.asarray(v0, dtype=np.float64), (num_envs,))
+        self.phi0 = np.broadcast_to(np.asarray(phi0, dtype=np.float64), (num_envs,))
+
+        self._states = [torch.zeros(num_envs, 5), torch.zeros(num_envs, 5)]
+        self.state = self._states[0]
+        self.curr_step = torch.zeros(num_envs, dtype=torch.long)
+        self.done = torch.zeros(num_envs, dtype=torch.bool)
+
+        self._dot = torch.zeros(num_envs, 5)
+        self._buf = torch.zeros(num_envs)
+        self._finished = torch.zeros(num_envs, dtype=torch.bool)
+        self._costs = torch.zeros(num_envs)
+        self._curr_time = torch.zeros(num_envs)
+
+    def _next_state(self):
+        return self._states[1] if self.state is self._states[0] else self._states[0]
+
+    def seed(self,seed=None):
+        self.np_random,seed=seeding.np_random(seed)
+
+    def step(self, action):
+        with torch.no_grad():
+            v = self.state[:, 2]
+            phi = self.state[:, 3]
+            dot = self._dot
+            buf = self._buf
+
+            torch.cos(phi, out=buf)
+            torch.mul(v, buf, out=dot[:, 0])
+            torch.sin(phi, out=buf)
+            torch.mul(v, buf, out=dot[:, 1])
+            dot[:, 2] = action[:, 2]
+            dot[:, 3] = self.state[:, 4]
+            dot[:, 4] = action[:, 3]
+
+            next_state = self._next_state()
+            torch.add(self.state, dot.mul_(self.dt), out=next_state)
+            self.state = next_state
+
+            self.curr_step += 1
+            self.done |= torch.eq(self.curr_step, self.num_steps, out=self._finished)
+            torch.mul(self.curr_step, self.dt, out=self._curr_time)
+
+        return self._get_obs(), self._costs, self.done, {"curr_time": self._curr_time}
+
+    def time(self):
+        return self.curr_step*self.dt
+
+    """
+    @params
+        mask: [N] bool, robots to reset, all of them by default
+
+    @return
+        observation [N, 5], v and phi of the reset robots drawn like A1_env.reset
+    """
+    def reset(self, mask=None):
+        if mask is None:
+            mask = torch.ones(self.num_envs, dtype=torch.bool)
+        idx = mask.nonzero().flatten().numpy()
+
+        v_init = np.random.uniform(0, self.v0[idx])
+        phi_init = np.random.uniform(-self.phi0[idx], self.phi0[idx])
+
+        state = self._next_state()
+        state.copy_(self.state)
+        state[idx] = 0
+        state[idx, 2] = torch.tensor(v_init, dtype=torch.float)
+        state[idx, 3] = torch.tensor(phi_init, dtype=torch.float)
+        self.state = state
+
+        self.curr_step[idx] = 0
+        self.done[idx] = False
+
+        return self._get_obs()
+
+    def _get_obs(self):
+        return self.state
+
+    def render(self):
+        return None
+
+    def close(self):
+        return None
+
+
+if __name__=="__main__":
+    #Vec_a1_env against one A1_env per robot, double actions like the controllers return
+    num_envs = 8
+    vec_env = Vec_a1_env(num_envs, total_time=5, dt=0.01, v0=0.5, phi0=0.2)
+    envs = [A1_env(total_time=5, dt=0.01) for _ in range(num_envs)]
+
+    obs = vec_env.reset()
+    for k, env in enumerate(envs):
+        env.reset()
+        env.state = obs[k].clone()
+
+    for _ in range(300):
+        action = torch.randn(num_envs, 4, dtype=torch.double)
+        obs = vec_env.step(action)[0]
+        ref = torch.stack([env.step(action[k])[0] for k, env in enumerate(envs)])
+
+    print("max state error against A1_env: ", torch.max(torch.abs(obs - ref)).item())
@@ -0,0 +1,303 @@
+import torch
+import numpy as np
+import argparse
+import time
+import json
+import os
+import sys
+import platform
+import subprocess
+import datetime
+import torch.optim as optim
+from helper import *
+from unroll import make_step, batch_controllers, batched_loss, serial_loss
+
+
+def _measure(fn, repeat, per=1, unit="us"):
+    """
+    Median and min over repeat timed calls of fn, after one warm-up call, divided by per
+    (the number of operations one call does)
+    """
+    fn() #warm up, compiles on the first call
+    scale = {"us": 1e6, "ms": 1e3, "s": 1}[unit]
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(scale*(time.perf_counter() - start)/per)
+    return {"median": float(np.median(samples)), "min": float(np.min(samples)), "unit": unit, "repeat": repeat}
+
+"""
+Per-step latency of the --batched unroll, controller objects against the fused step
+
+@params
+    env: "car" or "a1"
+    trajs: batch size
+    horizon, dt: sets the number of steps
+    backends: fused step backends to time next to the unfused loop
+
+@return
+    dict of name -> (forward us/step, forward + backward us/step)
+"""
+def bench_step(env="car", trajs=10, horizon=2, dt=0.002, backends=["eager", "script"], repeat=3):
+    params = {"horizon": horizon, "dt": dt, "terminal_weight": 10, "input_weight": 0.1}
+    stride = 10
+
+    if env == "car":
+        weights = torch.tensor([3, 3, 3, 3], dtype=torch.float)
+        state_dim = 4
+        action_dim = 2
+    else:
+        weights = torch.tensor([2, 2, 5, 2, 5], dtype=torch.float)
+        state_dim = 5
+        action_dim = 4
+    f_nominal = batch_nominals[env]
+
+    x0 = 0.1*torch.randn(trajs, state_dim)
+    pos_d = torch.randn(trajs, 2, dtype=torch.double, requires_grad=True)
+    vel_d = torch.randn(trajs, 2, dtype=torch.double, requires_grad=True)
+    residual = 1e-3*torch.randn(trajs, state_dim)
+    task_cost = Tracking_cost(torch.randn(trajs, 2*horizon), params, x0)
+    steps = len(task_cost.ts)
+
+    def unfused():
+        controller = batch_controllers[env](weights)
+        x = x0
+        loss = 0
+        for j in range(steps):
+            if j % stride == 0:
+                u = controller.control(pos_d, vel_d, x)
+                loss += task_cost.step(x, u, j).sum()
+            x = f_nominal(x, u, dt) + residual
+        return loss
+
+    def fused(step_fn):
+        def run():
+            x = x0
+            u = torch.zeros(trajs, action_dim, dtype=torch.double)
+            loss = 0
+            for j in range(steps):
+                if j % stride == 0:
+                    target = task_cost.targets[:, j]
+                    weight = task_cost.weights[j]
+                x, u, cost = step_fn(x, u, pos_d, vel_d, weights, residual, target, weight, j % stride == 0, j % stride == 0, float(params["input_weight"]), float(dt))
+                if j % stride == 0:
+                    loss += cost.sum()
+            return loss
+        return run
+
+    variants = {"unfused": unfused}
+    for backend in backends:
+        variants[backend] = fused(make_step(env, backend))
+
+    results = {}
+    for name, fn in variants.items():
+        forward = _measure(fn, repeat, per=steps)
+        backward = _measure(lambda: fn().backward(), repeat, per=steps)
+        results[name] = (forward["median"], backward["median"])
+
+    return results
+
+
+"""
+run.py defaults for the car, the settings every suite result is measured at
+"""
+def car_params(trajs=10, horizon=5, dt=0.002):
+    return {"env": "car", "horizon": horizon, "points_per_sec": 1, "trajs": trajs, "iterations": 100, "lr": 1e-3, "dt": dt,
+            "input_weight": 0, "loss_stride": 10, "terminal_weight": 10, "controller_stride": 10, "learn_weights": False,
+            "dubins_controller_weights": [3, 3, 3, 3], "dubins_dyn_coeffs": [0.5, 0.25, 0.95, 0, 0],
+            "traj_v_range": [0.3, 0.5], "traj_theta_range": [-0.5, 0.5], "traj_noise": 0, "model_scale": 1}
+
+def bench_spline(knots=[3, 6, 11, 21, 51], repeat=20):
+    results = {}
+    for n in knots:
+        x = torch.randn(n - 1)
+        y = torch.randn(n - 1)
+        ts = np.linspace(0, n - 1, 100)
+        spline = Spline(x, y)
+
+        def evaluate():
+            for t in ts:
+                spline.evaluate(t)
+
+        results["spline_init/knots={}".format(n)] = _measure(lambda: Spline(x, y), repeat)
+        results["spline_evaluate/knots={}".format(n)] = _measure(evaluate, repeat, per=len(ts))
+    return results
+
+def bench_env(steps=1000, repeat=5):
+    results = {}
+    envs = {"dubins_env_step": (Dubins_env(total_time=steps, dt=0.01, v0=0.5, phi0=0.2), [torch.tensor(0.1), torch.tensor(0.1)]),
+            "a1_env_step": (A1_env(total_time=steps, dt=0.01, v0=0.5, phi0=0.2), [torch.tensor(0.4), torch.tensor(0.1), torch.tensor(0.1), torch.tensor(0.1)])}
+    for name, (env, action) in envs.items():
+        def run():
+            env.reset()
+            for _ in range(steps):
+                env.step(action)
+        results[name] = _measure(run, repeat, per=steps)
+    return results
+
+def bench_controller(calls=200, repeat=5):
+    results = {}
+    spline = Spline(torch.randn(5), torch.randn(5))
+    ts = np.linspace(0, 5, calls)
+    controllers = {"dubins_controller_next_action": (Dubins_controller(torch.tensor([3, 3, 3, 3], dtype=torch.float)), torch.tensor([0.1, 0.1, 0.4, 0.1])),
+                   "a1_controller_next_action": (A1_controller(torch.tensor([2, 2, 5, 2, 5], dtype=torch.float)), torch.tensor([0.1, 0.1, 0.4, 0.1, 0.0]))}
+    for name, (controller, obs) in controllers.items():
+        def run():
+            for t in ts:
+                controller.next_action(t, spline, obs)
+        results[name] = _measure(run, repeat, per=calls)
+    return results
+
+def _car_setup(params):
+    model = make_model([2*params["horizon"] + 2, 32, 32, 2*params["points_per_sec"]*params["horizon"]])
+    return model, make_env(params), make_controller(params)
+
+def bench_collect(params, repeat=3):
+    model, env, controller = _car_setup(params)
+    return {"collect_trajs": _measure(lambda: collect_trajs(model, env, controller, params, 0), repeat, unit="s")}
+
+def bench_iteration(params, repeat=3, batched=True):
+    """
+    One run.py iteration on the car: collect, loss build, backward and optimizer step,
+    timed as a whole and per phase. batched=False builds the loss like run.py does
+    without --batched, one trajectory at a time
+    """
+    model, env, controller = _car_setup(params)
+    weights = torch.tensor(params["dubins_controller_weights"], dtype=torch.float)
+    optimizer = optim.Adam(model.parameters(), lr=params["lr"])
+    phases = {name: [] for name in ["collect", "loss", "backward", "total"]}
+
+    def iteration():
+        start = time.perf_counter()
+        optimizer.zero_grad()
+        residuals, x0s, tasks, points_set, deltas = collect_trajs(model, env, controller, params, 0)
+        collected = time.perf_counter()
+        if batched:
+            loss = batched_loss(deltas, residuals, x0s, tasks, points_set, params, weights)
+        else:
+            loss = serial_loss(deltas, residuals, x0s, tasks, points_set, params, weights, controller)
+        built = time.perf_counter()
+        loss.backward()
+        optimizer.step()
+        end = time.perf_counter()
+        for name, value in zip(phases, [collected - start, built - collected, end - built, end - start]):
+            phases[name].append(value)
+
+    iteration()
+    for values in phases.values():
+        values.clear()
+    for _ in range(repeat):
+        iteration()
+
+    prefix = "iteration/" if batched else "iteration_default/"
+    return {prefix + name: {"median": float(np.median(values)), "min": float(np.min(values)), "unit": "s", "repeat": repeat}
+            for name, values in phases.items()}
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"time": datetime.datetime.now().isoformat(timespec="seconds"), "commit": commit, "python": platform.python_version(),
+            "torch": torch.__version__, "numpy": np.__version__, "platform": platform.platform(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count(), "torch_threads": torch.get_num_threads()}
+
+"""
+Runs the benchmark suite
+
+@params
+    groups: subset of spline, env, controller, collect, iteration (--batched), iteration_default
+    params: car settings of collect and iteration
+
+@return
+    {"environment": ..., "params": ..., "results": {name: {"median", "min", "unit", "repeat"}}}
+"""
+def run_suite(groups=["spline", "env", "controller", "collect", "iteration", "iteration_default"], params=None, repeat=3):
+    if params is None:
+        params = car_params()
+
+    benches = {"spline": lambda: bench_spline(),
+               "env": lambda: bench_env(),
+               "controller": lambda: bench_controller(),
+               "collect": lambda: bench_collect(params, repeat),
+               "iteration": lambda: bench_iteration(params, repeat),
+               "iteration_default": lambda: bench_iteration(params, repeat, batched=False)}
+
+    results = {}
+    for group in groups:
+        print("Running {}".format(group), file=sys.stderr)
+        results.update(benches[group]())
+
+    return {"environment": environment(), "params": params, "results": results}
+
+"""
+@return
+    rows of (name, baseline, current, current / baseline) for the results in both files, by median
+"""
+def compare(baseline, current):
+    rows = []
+    for name, result in current["results"].items():
+        if name in baseline["results"]:
+            base = baseline["results"][name]["median"]
+            rows.append((name, base, result["median"], result["median"] / base, result["unit"]))
+    return rows
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="bench", required=True)
+
+    step = commands.add_parser("step")
+    step.add_argument('--env', type=str, default="car")
+    step.add_argument('--trajs', '-t', type=int, default=10)
+    step.add_argument('--horizon', type=int, default=2)
+    step.add_argument('--dt', type=float, default=0.002)
+    step.add_argument('--backends', type=str, nargs="+", default=["eager", "script", "compile"])
+
+    suite = commands.add_parser("suite")
+    suite.add_argument('--out', '-o', type=str, default=os.path.join("logs", "benchmark.json"))
+    suite.add_argument('--groups', type=str, nargs="+", default=["spline", "env", "controller", "collect", "iteration", "iteration_default"])
+    suite.add_argument('--trajs', '-t', type=int, default=10)
+    suite.add_argument('--horizon', type=int, default=5)
+    suite.add_argument('--dt', type=float, default=0.002)
+    suite.add_argument('--repeat', type=int, default=3)
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument('baseline', type=str)
+    compare_parser.add_argument('current', type=str)
+    compare_parser.add_argument('--threshold', type=float, default=0.1) #slowdown reported as a regression
+    args = parser.parse_args()
+
+    if args.bench == "step":
+        results = bench_step(args.env, args.trajs, args.horizon, args.dt, args.backends)
+        print("{:<10} {:>14} {:>20}".format("step", "forward us", "forward+backward us"))
+        for name, (forward, backward) in results.items():
+            print("{:<10} {:>14.1f} {:>20.1f}".format(name, forward, backward))
+
+    elif args.bench == "suite":
+        results = run_suite(args.groups, car_params(args.trajs, args.horizon, args.dt), args.repeat)
+        if os.path.dirname(args.out):
+            os.makedirs(os.path.dirname(args.out), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        for name, result in results["results"].items():
+            print("{:<40} {:>12.3f} {}".format(name, result["median"], result["unit"]))
+
+    elif args.bench == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+
+        regressions = 0
+        print("{:<40} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "current", "ratio"))
+        for name, base, value, ratio, unit in compare(baseline, current):
+            flag = ""
+            if ratio > 1 + args.threshold:
+                flag = "  slower"
+                regressions += 1
+            elif ratio < 1 - args.threshold:
+                flag = "  faster"
+            print("{:<40} {:>9.3f} {:<2} {:>9.3f} {:<2} {:>7.2f}x{}".format(name, base, unit, value, unit, ratio, flag))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,33 @@
+import torch
+import math
+from typing import Tuple
+
+def desired_heading(x_tilde_dot_d: torch.Tensor, y_tilde_dot_d: torch.Tensor, phi_act: torch.Tensor) -> torch.Tensor:
+    """
+    Branch-free heading of next_action for tensors of any shape: atan2 measured from
+    the positive x-axis in [0, 2pi), moved down by 2pi when that is closer to phi_act
+    """
+    phi_des = torch.atan2(y_tilde_dot_d, x_tilde_dot_d)
+    phi_des = torch.where(phi_des < 0, phi_des + 2*math.pi, phi_des)
+
+    return torch.where(torch.abs(phi_des - phi_act) > torch.abs(phi_des - 2*math.pi - phi_act), phi_des - 2*math.pi, phi_des)
+
+def desired_speed_heading(pos_d: torch.Tensor, vel_d: torch.Tensor, obs: torch.Tensor, k_x: torch.Tensor, k_y: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Tracking law shared by the car and A1 controllers: desired velocity corrected
+    towards the desired position, as a speed and a heading
+
+    @params
+        pos_d, vel_d: [..., 2] desired position and velocity
+        obs: [..., state] with x, y at 0, 1 and phi at 3
+        k_x, k_y: position gains, scalars or per trajectory
+
+    @return
+        v_des, phi_des: [...]
+    """
+    x_tilde_dot_d = vel_d[..., 0] + k_x*(pos_d[..., 0] - obs[..., 0])
+    y_tilde_dot_d = vel_d[..., 1] + k_y*(pos_d[..., 1] - obs[..., 1])
+
+    v_des = torch.sqrt(x_tilde_dot_d**2 + y_tilde_dot_d**2 + 1e-8)
+
+    return v_des, desired_heading(x_tilde_dot_d, y_tilde_dot_d, obs[..., 3])
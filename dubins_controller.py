@@ -5,8 +5,7 @@ import numpy as np
 from os import path
 from dubins_env import Dubins_env
 from spline import Spline
-import matplotlib
-import matplotlib.pyplot as plt
+from controller_utils import desired_speed_heading
 import torch
 import pdb
 from helper import *
@@ -78,7 +77,68 @@ class Dubins_controller:
 
         return action, [x_d, y_d], [x_act, y_act]
 
+class Batch_dubins_controller:
+    """
+    Description:
+        Dubins_controller for N cars at once, differentiable and without
+        branching on tensor values
+        weights: [4] shared gains or [N, 4] per car (learn_weights)
+    """
+    def __init__(self, weights=[1, 1, 1, 1]):
+
+        weights = torch.as_tensor(weights, dtype=torch.float)
+
+        #position gain
+        self.k_x = weights[..., 0]
+        self.k_y = weights[..., 1]
+
+        #speed gain
+        self.k_v = weights[..., 2]
+
+        #angle gain
+        self.k_phi = weights[..., 3]
+
+    """
+    @params
+        pos_d, vel_d: [N, 2] desired position and velocity
+        obs: [N, 4] states
+
+    @return
+        action: [N, 2] a, theta
+    """
+    def control(self, pos_d, vel_d, obs):
+
+        v_des, phi_des = desired_speed_heading(pos_d, vel_d, obs, self.k_x, self.k_y)
+
+        a = self.k_v*(v_des - obs[..., 2])
+        theta = self.k_phi*(phi_des - obs[..., 3])
+
+        return torch.stack((a, theta), dim=-1)
+
+    """
+    @params
+        curr_time: time at which to evaluate controls
+        spline: Batch_spline with N curves
+        obs: [N, 4] states
+
+    @return
+        action: [N, 2] a, theta
+        des_pos: [N, 2] desired location
+        act_pos: [N, 2] actual location
+    """
+    def next_action(self, curr_time, spline, obs):
+
+        x_d, y_d = spline.evaluate(curr_time, der=0)
+        x_dot_d, y_dot_d = spline.evaluate(curr_time, der=1)
+
+        pos_d = torch.stack((x_d, y_d), dim=-1)
+        action = self.control(pos_d, torch.stack((x_dot_d, y_dot_d), dim=-1), obs)
+
+        return action, pos_d, obs[..., :2]
+
 if __name__=="__main__":
+    import matplotlib.pyplot as plt
+
     horizon = 3
     env = Dubins_env(total_time=horizon, dt=0.002, f_v=0.5, f_phi=0.25, v0=0, phi0=0)
     controller = Dubins_controller([3, 3, 3, 3])
@@ -68,12 +68,16 @@ class Dubins_env(gym.Env):
         return self.curr_step*self.dt
 
     #We have this return v_init and phi_init so they can be added to task for input to the model
-    def reset(self):
+    #state: start from this state instead of drawing v_init and phi_init
+    def reset(self, state=None):
 
-        v_init = np.random.uniform(0, self.v0)
-        phi_init = np.random.uniform(-self.phi0, self.phi0)
+        if state is None:
+            v_init = np.random.uniform(0, self.v0)
+            phi_init = np.random.uniform(-self.phi0, self.phi0)
 
-        self.state = torch.tensor([0, 0, v_init, phi_init], dtype=torch.float)
+            self.state = torch.tensor([0, 0, v_init, phi_init], dtype=torch.float)
+        else:
+            self.state = state.clone()
         self.curr_step = 0
         self.done = False
 
@@ -92,3 +96,143 @@ class Dubins_env(gym.Env):
 
     def angle_normalize(self, x):
         return abs(((x + np.pi) % (2 * np.pi)) - np.pi)
+
+
+class Vec_dubins_env(gym.Env):
+    """
+    Description:
+        num_envs Dubins cars stepped together, same dynamics as Dubins_env
+        state [N, 4]: x, y, v, phi
+        action [N, 2]: a, theta
+        f_v, f_phi, scale, v0, phi0 are scalars or per car [N]
+        The step is not differentiable and allocates nothing: it runs under no_grad and
+        writes into buffers made in __init__. The state alternates between two buffers,
+        so an observation stays valid through the next step. The done, cost and
+        curr_time tensors returned by step are updated in place, clone them to keep them
+    """
+    metadata = {"render.modes": ["human", "rgb_array"], "video.frames_per_second": 30}
+
+    def __init__(self, num_envs, total_time=10, dt=0.01, f_v=0.1, f_phi=0.05, scale=0.95, v0=0, phi0=0):
+
+        max_state = np.array([100, 100, 100, 100])
+        max_input = np.array([10, 10])
+        self.action_space = spaces.Box(low=-np.tile(max_input, (num_envs, 1)), high=np.tile(max_input, (num_envs, 1)), shape=(num_envs, 2), dtype=np.float32)
+        self.observation_space = spaces.Box(low=-np.tile(max_state, (num_envs, 1)), high=np.tile(max_state, (num_envs, 1)), shape=(num_envs, 4), dtype=np.float32)
+
+        self.num_envs = num_envs
+        self.num_steps = total_time // dt
+        self.total_time = total_time
+        self.dt = dt
+        self.f_v = torch.as_tensor(f_v, dtype=torch.float).expand(num_envs).clone()
+        self.f_phi = torch.as_tensor(f_phi, dtype=torch.float).expand(num_envs).clone()
+        self.scale = torch.as_tensor(scale, dtype=torch.double).expand(num_envs).clone()
+        self._scales = {torch.double: self.scale, torch.float: self.scale.float()}
+        self.v0 = np.broadcast_to(np.asarray(v0, dtype=np.float64), (num_envs,))
+        self.phi0 = np.broadcast_to(np.asarray(phi0, dtype=np.float64), (num_envs,))
+
+        self._states = [torch.zeros(num_envs, 4), torch.zeros(num_envs, 4)]
+        self.state = self._states[0]
+        self.curr_step = torch.zeros(num_envs, dtype=torch.long)
+        self.done = torch.zeros(num_envs, dtype=torch.bool)
+
+        self._dot = torch.zeros(num_envs, 4)
+        self._buf = torch.zeros(num_envs)
+        self._rate = {torch.double: torch.zeros(num_envs, dtype=torch.double), torch.float: torch.zeros(num_envs)}
+        self._finished = torch.zeros(num_envs, dtype=torch.bool)
+        self._costs = torch.zeros(num_envs)
+        self._curr_time = torch.zeros(num_envs)
+
+    def _next_state(self):
+        return self._states[1] if self.state is self._states[0] else self._states[0]
+
+    def seed(self,seed=None):
+        self.np_random,seed=seeding.np_random(seed)
+
+    def step(self, action):
+        with torch.no_grad():
+            v = self.state[:, 2]
+            phi = self.state[:, 3]
+            dot = self._dot
+            buf = self._buf
+
+            torch.cos(phi, out=buf)
+            torch.mul(v, buf, out=dot[:, 0])
+            torch.sin(phi, out=buf)
+            torch.mul(v, buf, out=dot[:, 1])
+
+            # Summed in the action dtype and rounded once, like Dubins_env does for the controllers' double actions
+            scale = self._scales[action.dtype]
+            rate = self._rate[action.dtype]
+            torch.mul(scale, action[:, 0], out=rate).sub_(torch.mul(v, self.f_v, out=buf))
+            dot[:, 2].copy_(rate)
+            torch.mul(scale, action[:, 1], out=rate).sub_(torch.mul(phi, self.f_phi, out=buf))
+            dot[:, 3].copy_(rate)
+
+            next_state = self._next_state()
+            torch.add(self.state, dot.mul_(self.dt), out=next_state)
+            self.state = next_state
+
+            self.curr_step += 1
+            self.done |= torch.eq(self.curr_step, self.num_steps, out=self._finished)
+            torch.mul(self.curr_step, self.dt, out=self._curr_time)
+
+        return self._get_obs(), self._costs, self.done, {"curr_time": self._curr_time}
+
+    def time(self):
+        return self.curr_step*self.dt
+
+    """
+    @params
+        mask: [N] bool, cars to reset, all of them by default
+
+    @return
+        observation [N, 4], v and phi of the reset cars drawn like Dubins_env.reset
+    """
+    def reset(self, mask=None):
+        if mask is None:
+            mask = torch.ones(self.num_envs, dtype=torch.bool)
+        idx = mask.nonzero().flatten().numpy()
+
+        v_init = np.random.uniform(0, self.v0[idx])
+        phi_init = np.random.uniform(-self.phi0[idx], self.phi0[idx])
+
+        state = self._next_state()
+        state.copy_(self.state)
+        state[idx] = 0
+        state[idx, 2] = torch.tensor(v_init, dtype=torch.float)
+        state[idx, 3] = torch.tensor(phi_init, dtype=torch.float)
+        self.state = state
+
+        self.curr_step[idx] = 0
+        self.done[idx] = False
+
+        return self._get_obs()
+
+    def _get_obs(self):
+        return self.state
+
+    def render(self):
+        return None
+
+    def close(self):
+        return None
+
+
+if __name__=="__main__":
+    #Vec_dubins_env against one Dubins_env per car, double actions like the controllers return
+    num_envs = 8
+    f_v = np.linspace(0.1, 0.9, num_envs)
+    scale = np.linspace(0.8, 1.1, num_envs)
+    vec_env = Vec_dubins_env(num_envs, total_time=5, dt=0.01, f_v=f_v, f_phi=0.25, scale=scale, v0=0.5, phi0=0.2)
+    envs = [Dubins_env(total_time=5, dt=0.01, f_v=f_v[k], f_phi=0.25, scale=scale[k]) for k in range(num_envs)]
+
+    obs = vec_env.reset()
+    for k, env in enumerate(envs):
+        env.reset(obs[k])
+
+    for _ in range(300):
+        action = torch.randn(num_envs, 2, dtype=torch.double)
+        obs = vec_env.step(action)[0]
+        ref = torch.stack([env.step(action[k])[0] for k, env in enumerate(envs)])
+
+    print("max state error against Dubins_env: ", torch.max(torch.abs(obs - ref)).item())
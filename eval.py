@@ -11,32 +11,23 @@ import argparse
 import pdb
 import os
 import json
+import time
+import itertools
+import multiprocessing as mp
 from a1_controller import *
-from a1_learning_hierarchical.motion_imitation.envs.a1_env import A1GymEnv
-matplotlib.rcParams.update({'font.size': 8})
+from registry import controller_weights
 
 
 
-def evaluate_once(model, params, v=None, theta=None):
+def _as_vector(x):
+	return torch.stack(list(x)) if isinstance(x, (list, tuple)) else x
 
-	if params["env"] == "car":
-		weights = torch.tensor(params["dubins_controller_weights"], dtype=torch.float)
-		coeffs = params["dubins_dyn_coeffs"]
-
-		controller = Dubins_controller(weights)
-		dum_controller = Dubins_controller(weights)
-		env = Dubins_env(total_time=params["horizon"], dt=params["dt"], f_v=coeffs[0], f_phi=coeffs[1], scale=coeffs[2], v0=coeffs[3], phi0=coeffs[4])
-		dum_env = Dubins_env(total_time=params["horizon"], dt=params["dt"], f_v=coeffs[0], f_phi=coeffs[1], scale=coeffs[2], v0=coeffs[3], phi0=coeffs[4])
+def evaluate_once(model, params, v=None, theta=None, verbose=True):
 
-	elif params["env"] == "a1":
-		weights = torch.tensor(params["a1_controller_weights"], dtype=torch.float)
-
-		controller = A1_controller(weights)
-		dum_controller = A1_controller(weights)
-		env = A1GymEnv(total_time=params["horizon"], dt=params["dt"])
-		dum_env = A1GymEnv(total_time=params["horizon"], dt=params["dt"])
-		# env = A1_env(total_time=params["horizon"], dt=params["dt"])
-		# dum_env = A1_env(total_time=params["horizon"], dt=params["dt"])
+	controller = make_controller(params)
+	dum_controller = make_controller(params)
+	env = make_env(params)
+	dum_env = make_env(params)
 	
 	output_times = np.linspace(0, params["horizon"], params["points_per_sec"]*params["horizon"] + 1)
 
@@ -68,72 +59,65 @@ def evaluate_once(model, params, v=None, theta=None):
 
 	task_deltas = deltas[:2*params["points_per_sec"]*params["horizon"]]
 
-	print("Output: ", task_deltas)
+	if verbose:
+		print("Output: ", task_deltas)
 
 	if params["learn_weights"]:
 		controller_deltas = deltas[2*params["points_per_sec"]*params["horizon"]:]
-		if params["env"] == "car":
-			weights = torch.tensor(params["dubins_controller_weights"], dtype=torch.float)
-			controller = Dubins_controller(weights + controller_deltas)
-		elif params["env"] == "a1":
-			weights = torch.tensor(params["a1_controller_weights"], dtype=torch.float)
-			controller = A1_controller(weights + controller_deltas)
+		weights = torch.tensor(params[controller_weights[params["env"]]], dtype=torch.float)
+		controller = make_controller(params, weights + controller_deltas)
 
 	task_adj = task_points + task_deltas
 
 	spline = Spline(task_adj[:params["horizon"]*params["points_per_sec"]], task_adj[params["horizon"]*params["points_per_sec"]:], times=output_times, init_pos=x0)
 	task_spline = Spline(task[:params["horizon"]], task[params["horizon"]:], init_pos=x0)
 	dum_task_spline = Spline(task[:params["horizon"]], task[params["horizon"]:], init_pos=dum_obs)
+	task_cost = Tracking_cost(task, params, x0)
+	dum_task_cost = Tracking_cost(task, params, dum_x0)
+
+	ts = np.arange(0, params["horizon"] + params["dt"], params["dt"])
+	is_controller_step = np.arange(len(ts)) % params["controller_stride"] == 0
+	to_controller_step = np.cumsum(is_controller_step) - 1
+
+	# Everything is recorded into tensors and read back once after the rollout
+	act = torch.zeros(len(ts), len(obs))
+	dum = torch.zeros(len(ts), len(dum_obs))
 
-	des_x = []
-	des_y = []
-	act_x = []
-	act_y = []
-	act_phi = []
-	tar_x = []
-	tar_y = []
-	#naive follower
-	dum_x = []
-	dum_y = []
-	dum_phi = []
-	dum_tar_x = []
-	dum_tar_y = []
-
-
-	smart_loss = 0
-	dum_loss = 0
-	i = 0
-	for t in np.arange(0, params["horizon"] + params["dt"], params["dt"]):
+	for i, t in enumerate(ts):
 		if (i % params["controller_stride"] == 0):
 			u, des_pos, act_pos= controller.next_action(t, spline, obs)
 			dum_u, _, dum_pos = dum_controller.next_action(t, dum_task_spline, dum_obs)
-			des_x.append(des_pos[0].detach().item())
-			des_y.append(des_pos[1].detach().item())
-			tar_pos_x, tar_pos_y = task_spline.evaluate(t, der=0)
-			dum_tar_pos_x, dum_tar_pos_y = dum_task_spline.evaluate(t, der=0)
+			step_values = [_as_vector(des_pos)[:2], _as_vector(u), _as_vector(dum_u),
+			               _as_vector(task_spline.evaluate(t, der=0)), _as_vector(dum_task_spline.evaluate(t, der=0))]
+			if i == 0:
+				des, us, dum_us, tar, dum_tar = [torch.zeros((is_controller_step.sum(),) + value.shape, dtype=value.dtype) for value in step_values]
+			for buffer, value in zip([des, us, dum_us, tar, dum_tar], step_values):
+				buffer[to_controller_step[i]] = value.detach()
 
 		obs, reward, done, info = env.step(u)
 		dum_obs, _, _, _ = dum_env.step(dum_u)
 
-		act_x.append(obs[0].detach().item())
-		act_y.append(obs[1].detach().item())
-		act_phi.append(obs[3].detach().item())
-		tar_x.append(tar_pos_x.detach().item())
-		tar_y.append(tar_pos_y.detach().item())
-		dum_x.append(dum_obs[0].detach().item())
-		dum_y.append(dum_obs[1].detach().item())
-		dum_phi.append(dum_obs[3].detach().item())
-		dum_tar_x.append(dum_tar_pos_x.detach().item())
-		dum_tar_y.append(dum_tar_pos_y.detach().item())
+		act[i] = obs.detach()
+		dum[i] = dum_obs.detach()
 
-		smart_loss += cost(obs, u, t, task, params, x0).detach().item()
-		dum_loss += cost(dum_obs, dum_u, t, task, params, dum_x0).detach().item()
+	des_x, des_y = des.T.tolist()
+	act_x, act_y, act_phi = act[:, [0, 1, 3]].T.tolist()
+	dum_x, dum_y, dum_phi = dum[:, [0, 1, 3]].T.tolist()
+	# Targets and actions are held from the last controller step
+	tar_x, tar_y = tar[to_controller_step].T.tolist()
+	dum_tar_x, dum_tar_y = dum_tar[to_controller_step].T.tolist()
 
-		i += 1
+	# Summed in step order like the running total it replaces
+	smart_loss = sum(task_cost(act, us[to_controller_step]).tolist())
+	dum_loss = sum(dum_task_cost(dum, dum_us[to_controller_step]).tolist())
 
 	return [des_x, des_y], [act_x, act_y, act_phi], [tar_x, tar_y], [dum_x, dum_y, dum_phi], [dum_tar_x, dum_tar_y],[smart_loss, dum_loss], task_points, task_adj.detach(), x0, dum_x0
 
 def evaluate(path, model_name, save_fig):
+	# Only the plotting path needs matplotlib, headless runs never import it
+	import matplotlib
+	import matplotlib.pyplot as plt
+	matplotlib.rcParams.update({'font.size': 8})
 
 	trials = 3
 
@@ -181,11 +165,102 @@ def evaluate(path, model_name, save_fig):
 		plt.show()
 
 
+_trial_model = None
+_trial_params = None
+
+def _set_trial(model, params):
+	global _trial_model, _trial_params
+	_trial_model = model
+	_trial_params = params
+
+def _init_trial_worker(model, params):
+	#one intra-op thread per pool worker, the workers already use the cores
+	torch.set_num_threads(1)
+	_set_trial(model, params)
+
+def _evaluate_trial(trial):
+	v, theta, seed = trial
+	np.random.seed(seed)
+	torch.manual_seed(seed[0]*1000003 + seed[1]*1009 + seed[2])
+	with torch.no_grad():
+		loss = evaluate_once(_trial_model, _trial_params, v, theta, verbose=False)[5]
+	return loss
+
+def _stats(losses):
+	losses = np.asarray(losses)
+	stats = {"mean": float(np.mean(losses)), "std": float(np.std(losses))}
+	for q in [5, 25, 50, 75, 95]:
+		stats["p{}".format(q)] = float(np.percentile(losses, q))
+	return stats
+
+"""
+Headless evaluation: trials of the model and the naive follower spread over worker
+processes, no plots
+
+@params
+	trials: trials per (v, theta) cell
+	v_grid, theta_grid: task velocities / turn rates to evaluate, None samples them from the
+		training ranges (one cell when both are None)
+	workers: processes, 0 runs the trials here
+	seed: trial t of cell c is seeded with (seed, c, t)
+	out: JSON file for the results, default eval_<model_name>.json in path
+
+@return
+	dict with loss statistics of the model and the naive follower over all trials and per cell
+"""
+def evaluate_grid(path, model_name, trials=20, v_grid=None, theta_grid=None, workers=0, seed=0, out=None):
+	model = torch.load(os.path.join(path, model_name))
+	with open(os.path.join(path, 'params.json')) as json_file:
+		params = json.load(json_file)
+
+	cells = list(itertools.product(v_grid or [None], theta_grid or [None]))
+	jobs = [(v, theta, [seed, c, t]) for c, (v, theta) in enumerate(cells) for t in range(trials)]
+
+	start = time.perf_counter()
+	if workers > 0:
+		with mp.get_context("fork").Pool(workers, initializer=_init_trial_worker, initargs=(model, params)) as pool:
+			losses = pool.map(_evaluate_trial, jobs, chunksize=max(1, len(jobs) // (4*workers)))
+	else:
+		_set_trial(model, params)
+		losses = [_evaluate_trial(job) for job in jobs]
+	elapsed = time.perf_counter() - start
+
+	losses = np.asarray(losses)
+	results = {"model": _stats(losses[:, 0]), "naive": _stats(losses[:, 1]),
+	           "model_better": float(np.mean(losses[:, 0] < losses[:, 1])),
+	           "trials": len(jobs), "seconds": elapsed, "cells": []}
+	for c, (v, theta) in enumerate(cells):
+		cell = losses[c*trials:(c + 1)*trials]
+		results["cells"].append({"v": v, "theta": theta, "model": _stats(cell[:, 0]), "naive": _stats(cell[:, 1]),
+		                         "model_losses": cell[:, 0].tolist(), "naive_losses": cell[:, 1].tolist()})
+
+	if out is None:
+		out = os.path.join(path, "eval_{}.json".format(os.path.splitext(model_name)[0]))
+	with open(out, "w") as f:
+		json.dump(results, f, indent=2)
+
+	print("{} trials in {:.1f}s, results in {}".format(len(jobs), elapsed, out))
+	print("Model Loss: mean {:.3f} median {:.3f} [p5 {:.3f}, p95 {:.3f}]".format(results["model"]["mean"], results["model"]["p50"], results["model"]["p5"], results["model"]["p95"]))
+	print("Naive Loss: mean {:.3f} median {:.3f} [p5 {:.3f}, p95 {:.3f}]".format(results["naive"]["mean"], results["naive"]["p50"], results["naive"]["p5"], results["naive"]["p95"]))
+
+	return results
+
+
 if __name__=="__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--run_name', '-n', type=str, default="car_test1")
 	parser.add_argument('--model_name', type=str, default="best_model.pt")
 	parser.add_argument('--save',  action='store_true')
+	parser.add_argument('--headless', action='store_true') #aggregate statistics to JSON instead of plotting three trials
+	parser.add_argument('--trials', type=int, default=20) #trials per (v, theta) cell in --headless
+	parser.add_argument('--v_grid', type=float, nargs="+", default=None)
+	parser.add_argument('--theta_grid', type=float, nargs="+", default=None)
+	parser.add_argument('--workers', type=int, default=os.cpu_count())
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--out', type=str, default=None)
 	args  = parser.parse_args()
 
-	evaluate(os.path.join("./logs", args.run_name), args.model_name, args.save)
+	if args.headless:
+		evaluate_grid(os.path.join("./logs", args.run_name), args.model_name, args.trials, args.v_grid, args.theta_grid, args.workers, args.seed, args.out)
+	else:
+		evaluate(os.path.join("./logs", args.run_name), args.model_name, args.save)
@@ -1,9 +1,9 @@
 import torch
 import torch.nn as nn
 import numpy as np
-from spline import Spline
-import matplotlib
-import matplotlib.pyplot as plt
+from spline import Spline, Batch_spline, sample_spline
+from timers import timer
+from registry import make_env, make_controller
 import pdb
 from dubins_controller import *
 from dubins_env import *
@@ -56,15 +56,56 @@ def generate_traj(horizon=5, noise=0.6, v_range=[1, 4], theta_range=[-np.pi/4, n
 def find_points(task, params):
     spline = Spline(task[:params["horizon"]], task[params["horizon"]:])
     ts = np.linspace(0, params["horizon"], params["points_per_sec"]*params["horizon"] + 1)
-    xs = []
-    ys = []
+    pos, _, _ = spline.sample(ts[1:]) #ignore 0
+
+    return torch.hstack((pos[:, 0], pos[:, 1])).float()
+
+"""
+Batched generate_traj: the same Euler unicycle at dt = 0.1, integrated for all tasks
+at once with a cumulative sum over the steps. Draws all v, then all theta, then the
+noise of every knot, so B = 1 reproduces generate_traj up to float rounding
 
-    for t in ts[1:]: #ignore 0
-        x, y = spline.evaluate(t)
-        xs.append(x)
-        ys.append(y)
+@params
+    B: number of tasks
+    rng: np.random.Generator or seed, None draws from np.random
 
-    return torch.hstack((torch.tensor(xs, dtype=torch.float), torch.tensor(ys, dtype=torch.float)))
+@return
+    tasks: [B, 2*horizon] x knots then y knots
+"""
+def generate_trajs(B, horizon=5, noise=0.6, v_range=[1, 4], theta_range=[-np.pi/4, np.pi/4], rng=None):
+    dt = 0.1
+    if rng is None:
+        rng = np.random
+    elif not isinstance(rng, np.random.Generator):
+        rng = np.random.default_rng(rng)
+
+    v = rng.uniform(v_range[0], v_range[1], size=B)
+    theta = rng.uniform(theta_range[0], theta_range[1], size=B)
+    steps = np.arange(int(horizon/dt) + 1)
+    knots = steps[(steps % int(1/dt) == 0) & (steps != 0)]
+    knot_noise = rng.uniform(-noise, noise, size=(B, len(knots), 2))
+
+    # Heading before step i is i*dt*theta, noise added at a knot stays in every later position
+    psi = dt*theta[:, None]*steps
+    xs = np.cumsum(dt*v[:, None]*np.cos(psi), axis=1)[:, knots] + np.cumsum(knot_noise[..., 0], axis=1)
+    ys = np.cumsum(dt*v[:, None]*np.sin(psi), axis=1)[:, knots] + np.cumsum(knot_noise[..., 1], axis=1)
+
+    return torch.cat((torch.tensor(xs, dtype=torch.float), torch.tensor(ys, dtype=torch.float)), dim=-1)
+
+"""
+Batched find_points, all tasks fitted and sampled together
+
+@params
+    tasks: [B, 2*horizon]
+
+@return
+    points: [B, 2*points_per_sec*horizon]
+"""
+def find_points_batch(tasks, params):
+    ts = np.linspace(0, params["horizon"], params["points_per_sec"]*params["horizon"] + 1)
+    pos, _, _ = sample_spline(tasks[:, :params["horizon"]], tasks[:, params["horizon"]:], ts[1:]) #ignore 0
+
+    return torch.cat((pos[..., 0], pos[..., 1]), dim=-1).float()
 
 def car_nominal(x, u, dt): 
     x_clone = x.clone()
@@ -87,6 +128,29 @@ def a1_nominal(x, u, dt):
 
 nominals = {"car": car_nominal, "a1": a1_nominal}
 
+def car_nominal_batch(x, u, dt):
+    """
+    car_nominal over [..., 4] states and [..., 2] actions, kept in the dtype of x
+    """
+    return torch.stack((x[..., 0] + x[..., 2] * torch.cos(x[..., 3]) * dt,
+                        x[..., 1] + x[..., 2] * torch.sin(x[..., 3]) * dt,
+                        x[..., 2] + u[..., 0] * dt,
+                        x[..., 3] + u[..., 1] * dt), dim=-1).to(x.dtype)
+
+def a1_nominal_batch(x, u, dt):
+    """
+    a1_nominal over [..., 5] states and [..., >=2] actions, kept in the dtype of x
+    """
+    return torch.stack((x[..., 0] + x[..., 2] * torch.cos(x[..., 3]) * dt,
+                        x[..., 1] + x[..., 2] * torch.sin(x[..., 3]) * dt,
+                        x[..., 2] + u[..., 0] * dt,
+                        x[..., 3] + x[..., 4] * dt,
+                        x[..., 4] + u[..., 1] * dt), dim=-1).to(x.dtype)
+
+batch_nominals = {"car": car_nominal_batch, "a1": a1_nominal_batch}
+state_dims = {"car": 4, "a1": 5}
+action_dims = {"car": 2, "a1": 4}
+
 def cost(x, u, t, task, params, init_pos):
 
     spline = Spline(task[:params["horizon"]], task[params["horizon"]:], init_pos=init_pos)
@@ -99,23 +163,73 @@ def cost(x, u, t, task, params, init_pos):
         
     return ret
 
+class Tracking_cost:
+    """
+    Description:
+        cost() for a fixed task and init_pos, with the target spline sampled once
+        on the simulation time grid np.arange(0, horizon + dt, dt)
+        task: [2*horizon] or [B, 2*horizon], init_pos: [>=2] or [B, >=2]
+    """
+    def __init__(self, task, params, init_pos):
+        self.params = params
+        self.ts = np.arange(0, params["horizon"] + params["dt"], params["dt"])
+
+        spline = Batch_spline(task[..., :params["horizon"]], task[..., params["horizon"]:], init_pos=init_pos)
+        self.targets, _, _ = spline.sample(self.ts)
+
+        self.weights = torch.ones(len(self.ts), dtype=torch.double)
+        self.weights[self.ts == params["horizon"]] = params["terminal_weight"]
+
+    """
+    @params
+        x: state at grid step k
+        u: action, list or tensor
+        k: index into self.ts
+
+    @return
+        same value as cost(x, u, self.ts[k], task, params, init_pos)
+    """
+    def step(self, x, u, k):
+        if isinstance(u, (list, tuple)):
+            u = torch.stack(list(u))
+        return self(x.unsqueeze(-2), u.unsqueeze(-2), [k])[..., 0]
+
+    """
+    @params
+        xs: [..., K, state] states
+        us: [..., K, action] actions
+        steps: the K grid indices xs are at, defaults to the whole grid
+
+    @return
+        [..., K] cost at every step, terminal weight included
+    """
+    def __call__(self, xs, us, steps=None):
+        if steps is None:
+            steps = np.arange(xs.shape[-2])
+
+        target = self.targets[..., steps, :]
+        ret = ((xs[..., 0] - target[..., 0])**2 + (xs[..., 1] - target[..., 1])**2) + (self.params["input_weight"] * (us[..., 0]**2 + us[..., 1]**2))
+
+        return ret*self.weights[steps]
+
 def model_input(task, obs, params):
     if params["env"] == "car":
-        res = torch.hstack((task, obs[2:]))
+        res = torch.cat((task, obs[..., 2:]), dim=-1)
     if params["env"] == "a1":
-        res = torch.hstack((task, obs[2:]))
+        res = torch.cat((task, obs[..., 2:]), dim=-1)
     return res
 
 def a1_warm_up(env, controller, params):
-    obs = env.reset()
-    env.warm_up = True
-    v_des = torch.tensor(np.random.uniform(params["a1_warm_up_vel"][0], params["a1_warm_up_vel"][1]), dtype=torch.float)
-    phi_des = torch.tensor(0, dtype=torch.float)
-    for _ in np.arange(0, params["a1_warm_up_time"], params["dt"]):
-        action = controller.next_action_warm_up(v_des, phi_des, obs)
-        obs, reward, done, info = env.step(action)
-    env.init_time = env.robot.GetTimeSinceReset()
-    env.warm_up = False
+    with timer.phase("warm_up"):
+        obs = env.reset()
+        env.warm_up = True
+        v_des = torch.tensor(np.random.uniform(params["a1_warm_up_vel"][0], params["a1_warm_up_vel"][1]), dtype=torch.float)
+        phi_des = torch.tensor(0, dtype=torch.float)
+        for _ in np.arange(0, params["a1_warm_up_time"], params["dt"]):
+            action = controller.next_action_warm_up(v_des, phi_des, obs)
+            obs, reward, done, info = env.step(action)
+        env.init_time = env.robot.GetTimeSinceReset()
+        env.warm_up = False
     print("--------------WARMED UP----------------")
     return obs
 
@@ -123,65 +237,151 @@ def heading_arrays(xs, ys, phis, stride=5):
     return xs[::stride], ys[::stride], [np.cos(phi) for phi in phis[::stride]], [np.sin(phi) for phi in phis[::stride]] 
 
 
-def collect_trajs(model, env, controller, params, i):
+"""
+Model output for a batch of tasks, scaled up over the first half of training
+
+@params
+    tasks: [..., 2*horizon], x0s: [..., state]
+    i: training iteration
+
+@return
+    deltas: [..., outputs] on the spline points, then on the controller gains when learn_weights
+"""
+def model_deltas(model, tasks, x0s, params, i):
+    return model(model_input(tasks, x0s, params))*params["model_scale"]*(min(1, 2*(i+1)/params["iterations"]))
+
+"""
+Start of a trajectory: reset for the car, reset and warm-up for the A1
+
+@params
+    x0: car start state to reset to instead of drawing one
+"""
+def start_traj(env, controller, params, x0=None):
+    if params["env"] == "car":
+        return env.reset(x0)
+    elif params["env"] == "a1":
+        return a1_warm_up(env, controller, params)
+
+"""
+Runs one trajectory from obs, the env state after start_traj
+
+@params
+    deltas: [outputs] model output for this task, without grad
+    out: dict of obs, actions, next_obs [steps, ...] buffers to record into, e.g. a Rollout_store slot
+
+@return
+    residual: [steps, state] next_obs - f_nominal(obs, action) at every simulation step
+"""
+def rollout_traj(env, controller, params, obs, task, points, deltas, out=None):
 
     output_times = np.linspace(0, params["horizon"], params["points_per_sec"]*params["horizon"] + 1)
+    ts = np.arange(0, params["horizon"] + params["dt"], params["dt"])
+
+    task_deltas = deltas[:2*params["points_per_sec"]*params["horizon"]]
+
+    if params["learn_weights"]:
+        controller_deltas = deltas[2*params["points_per_sec"]*params["horizon"]:]
+        if params["env"] == "car":
+            weights = torch.tensor(params["dubins_controller_weights"], dtype=torch.float)
+        elif params["env"] == "a1":
+            weights = torch.tensor(params["a1_controller_weights"], dtype=torch.float)
+        controller = make_controller(params, weights + controller_deltas)
+
+    task_adj = points + task_deltas
+
+    with timer.phase("spline"):
+        spline = Spline(task_adj[:params["horizon"]*params["points_per_sec"]], task_adj[params["horizon"]*params["points_per_sec"]:], times=output_times, init_pos=obs)
+
+    # Steps are written in place, into a Rollout_store slot when out is given
+    if out is None:
+        out = {"obs": torch.zeros(len(ts), state_dims[params["env"]]),
+               "actions": torch.zeros(len(ts), action_dims[params["env"]], dtype=torch.double),
+               "next_obs": torch.zeros(len(ts), state_dims[params["env"]])}
+
+    for j in range(len(ts)):
+        if (j % params["controller_stride"] == 0):
+            action, des_pos, act_pos = controller.next_action(ts[j], spline, obs)
+        next_obs, reward, done, info = env.step(action)
+        out["obs"][j] = obs
+        out["actions"][j] = torch.stack(list(action)) if isinstance(action, (list, tuple)) else action
+        out["next_obs"][j] = next_obs
+        obs = next_obs
+
+    # Time-varying dynamics as the residual of the nominal model at every step
+    return out["next_obs"] - batch_nominals[params["env"]](out["obs"], out["actions"], params["dt"])
+
+"""
+One trajectory with its own model call, for starts that have to be rolled out right
+away (the A1 warm-up state cannot be restored). i is the training iteration
+
+@return
+    residual: [steps, state] next_obs - f_nominal(obs, action) at every simulation step
+    x0, task, points: start state, task and spline points
+"""
+def collect_traj(model, env, controller, params, i, out=None, task=None, points=None):
+    if task is None:
+        task = generate_traj(params["horizon"], params["traj_noise"], params["traj_v_range"], params["traj_theta_range"])
+        points = find_points(task, params)
 
     with torch.no_grad():
-        trajs = []
+        x0 = start_traj(env, controller, params)
+        deltas = model_deltas(model, task, x0, params, i)
+
+        return rollout_traj(env, controller, params, x0, task, points, deltas, out), x0, task, points
+
+"""
+Collects params["trajs"] trajectories. Car starts are drawn before any rollout, so the
+model runs once on all tasks and the rollouts use that output. A1 starts come out of a
+warm-up that has to be rolled out right away, so each A1 rollout calls the model itself
+and the returned deltas come from one forward on all starts afterwards
+
+@params
+    store: Rollout_store the iteration is written into, None keeps it in memory
+
+@return
+    residuals: [trajs, steps, state] next_obs - f_nominal(obs, action) at every simulation step
+    x0s, tasks, points_set: per trajectory start state, task and spline points
+    deltas: [trajs, outputs] model output with grad, for the loss
+"""
+def collect_trajs(model, env, controller, params, i, store=None):
+
+    if store is not None:
+        n, slot = store.next_slot()
+    outs = [None if store is None else {name: slot[name][k] for name in ["obs", "actions", "next_obs"]} for k in range(params["trajs"])]
+
+    tasks = generate_trajs(params["trajs"], params["horizon"], params["traj_noise"], params["traj_v_range"], params["traj_theta_range"])
+    points_set = find_points_batch(tasks, params)
+
+    if params["env"] == "car":
+        x0s = torch.stack([start_traj(env, controller, params) for _ in range(params["trajs"])])
+        deltas = model_deltas(model, tasks, x0s, params, i)
+
+        with torch.no_grad():
+            residuals = torch.stack([rollout_traj(env, controller, params, start_traj(env, controller, params, x0s[k]), tasks[k], points_set[k], deltas[k].detach(), outs[k])
+                                     for k in range(params["trajs"])])
+    else:
+        residuals = []
         x0s = []
-        tasks = []
-        points_set = []
-        for i in range(params["trajs"]):
-            task = generate_traj(params["horizon"], params["traj_noise"], params["traj_v_range"], params["traj_theta_range"])
-            tasks.append(task)
-            if params["env"] == "car":
-                obs = env.reset()
-            elif params["env"] == "a1":
-                obs = a1_warm_up(env, controller, params)
-            x0s.append(obs)
-            points = find_points(task, params)
-            points_set.append(points)
-
-            deltas = model(model_input(task, obs, params))*params["model_scale"]*(min(1, 2*(i+1)/params["iterations"]))
-
-            task_deltas = deltas[:2*params["points_per_sec"]*params["horizon"]]
-
-            if params["learn_weights"]:
-                controller_deltas = deltas[2*params["points_per_sec"]*params["horizon"]:]
-                if params["env"] == "car":
-                    weights = torch.tensor(params["dubins_controller_weights"], dtype=torch.float)
-                    controller = Dubins_controller(weights + controller_deltas)
-                elif params["env"] == "a1":
-                    weights = torch.tensor(params["a1_controller_weights"], dtype=torch.float)
-                    controller = A1_controller(weights + controller_deltas)
-
-            task_adj = points + task_deltas
-
-            spline = Spline(task_adj[:params["horizon"]*params["points_per_sec"]], task_adj[params["horizon"]*params["points_per_sec"]:], times=output_times, init_pos=obs)
-            traj = []
-            k = 0
-            for j in np.arange(0, params["horizon"] + params["dt"], params["dt"]):
-                if (k % params["controller_stride"] == 0):
-                    action, des_pos, act_pos = controller.next_action(j, spline, obs)
-                next_obs, reward, done, info = env.step(action)
-                traj.append((obs, action, reward, next_obs, done))
-                obs = next_obs
-                k += 1
-            trajs.append(traj)
-
-        # Make time-varying dynamics
-        fs = []
-        for traj in trajs:
-            dyn_tuples = []
-            for obs, action, reward, next_obs, done in traj:
-                dyn_tuples.append((obs, action, next_obs))
-            fs.append(dyn_tuples)
-
-    return fs, x0s, tasks, points_set
+        for k in range(params["trajs"]):
+            residual, x0, _, _ = collect_traj(model, env, controller, params, i, outs[k], tasks[k], points_set[k])
+            residuals.append(residual)
+            x0s.append(x0)
+        residuals = torch.stack(residuals)
+        x0s = torch.stack(x0s)
+        deltas = model_deltas(model, tasks, x0s, params, i)
+
+    if store is None:
+        return residuals, list(x0s), list(tasks), list(points_set), deltas
+
+    for name, values in zip(store.traj_fields, [residuals, x0s, tasks, points_set]):
+        slot[name].copy_(values)
+    store.append(i)
+
+    return store.load(n) + (deltas,)
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
 
     horizon = 3
 
@@ -193,15 +393,9 @@ if __name__ == "__main__":
 
         cs = Spline(task[:horizon], task[horizon:])
 
-        times = np.linspace(0, horizon, 40)
-        xs = []
-        ys = []
-        for time in times:
-            x, y = cs.evaluate(time)
-            xs.append(x)
-            ys.append(y)
+        pos, _, _ = cs.sample(np.linspace(0, horizon, 40))
 
-        plt.plot(xs, ys)
+        plt.plot(pos[:, 0], pos[:, 1])
 
     plt.show()
 
@@ -0,0 +1,255 @@
+import torch
+import torch.multiprocessing as mp
+import numpy as np
+import copy
+import traceback
+from helper import *
+from timers import timer
+
+def _collect_worker(worker_id, indices, params, model, buffers, store, commands, results, seed):
+    torch.set_num_threads(1)
+    try:
+        env = make_env(params)
+        controller = make_controller(params)
+        setup_error = None
+    except Exception:
+        setup_error = traceback.format_exc()
+    timer.take() #drop phases inherited from the parent
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        phase, i, n = command
+
+        # A worker without an env still answers, otherwise collect waits forever
+        if setup_error is not None:
+            results.put((worker_id, setup_error, {}))
+            continue
+
+        try:
+            # Results go straight into the store slot when there is one, the mapping is shared with the parent
+            slot = buffers if n is None else store.slot(n)
+            outs = [None if n is None else {name: slot[name][k] for name in ["obs", "actions", "next_obs"]} for k in indices]
+
+            with torch.no_grad(), timer.phase("collect"):
+                if phase in ["start", "collect"]:
+                    np.random.seed([seed, worker_id, i])
+                    torch.manual_seed(seed*1000003 + worker_id*1009 + i)
+
+                    tasks = generate_trajs(len(indices), params["horizon"], params["traj_noise"], params["traj_v_range"], params["traj_theta_range"])
+                    points_set = find_points_batch(tasks, params)
+                    slot["tasks"][indices] = tasks
+                    slot["points"][indices] = points_set
+
+                if phase == "start":
+                    for k in indices:
+                        slot["x0s"][k].copy_(start_traj(env, controller, params))
+
+                elif phase == "rollout":
+                    for k, out in zip(indices, outs):
+                        obs = start_traj(env, controller, params, slot["x0s"][k].clone())
+                        slot["residuals"][k].copy_(rollout_traj(env, controller, params, obs, slot["tasks"][k], slot["points"][k], buffers["deltas"][k], out))
+
+                elif phase == "collect":
+                    for k, task, points, out in zip(indices, tasks, points_set, outs):
+                        residual, x0, _, _ = collect_traj(model, env, controller, params, i, out, task, points)
+                        slot["residuals"][k].copy_(residual)
+                        slot["x0s"][k].copy_(x0)
+
+            results.put((worker_id, None, timer.take()))
+        except Exception:
+            results.put((worker_id, traceback.format_exc(), timer.take()))
+
+class Collector_pool:
+    """
+    Description:
+        collect_trajs spread over persistent worker processes, each owning its own env
+        (Dubins_env or A1GymEnv) and collecting a fixed subset of the trajectories.
+        Car collection runs in two phases like collect_trajs: workers draw the starts, the
+        model runs once on all of them here, then workers roll out with the detached output
+        from a shared buffer. A1 workers collect whole trajectories with a shared-memory
+        copy of the model, updated at every collect. Results come back through
+        preallocated shared-memory tensors.
+        Worker RNGs are seeded from (seed, worker, iteration) so runs are reproducible.
+        Workers time their own collect (and warm_up, spline) phases, which collect adds
+        to the learner's timer.
+        With a Rollout_store (created before the pool, so its mapping is inherited)
+        workers write into the store slot instead
+    """
+    def __init__(self, model, params, workers, seed=0, store=None):
+        ctx = mp.get_context("fork")
+
+        self.params = params
+
+        steps = len(np.arange(0, params["horizon"] + params["dt"], params["dt"]))
+        state_dim = state_dims[params["env"]]
+        num_points = params["points_per_sec"]*params["horizon"]
+
+        self.store = store
+        self.model = copy.deepcopy(model).share_memory()
+        self.buffers = {"residuals": torch.zeros(params["trajs"], steps, state_dim).share_memory_(),
+                        "x0s": torch.zeros(params["trajs"], state_dim).share_memory_(),
+                        "tasks": torch.zeros(params["trajs"], 2*params["horizon"]).share_memory_(),
+                        "points": torch.zeros(params["trajs"], 2*num_points).share_memory_(),
+                        "deltas": torch.zeros(params["trajs"], list(model.parameters())[-1].shape[0]).share_memory_()}
+
+        self.results = ctx.Queue()
+        self.commands = [ctx.Queue() for _ in range(workers)]
+        self.procs = []
+        for w in range(workers):
+            indices = list(range(w, params["trajs"], workers))
+            proc = ctx.Process(target=_collect_worker, args=(w, indices, params, self.model, self.buffers, store, self.commands[w], self.results, seed), daemon=True)
+            proc.start()
+            self.procs.append(proc)
+
+    def _run(self, phase, i, n):
+        for commands in self.commands:
+            commands.put((phase, i, n))
+
+        errors = []
+        phases = []
+        for _ in self.procs:
+            worker_id, error, worker_phases = self.results.get()
+            phases.append(worker_phases)
+            if error is not None:
+                errors.append("worker {}:\n{}".format(worker_id, error))
+        timer.add(phases)
+
+        if errors:
+            raise RuntimeError("Trajectory collection failed in " + "\n".join(errors))
+
+    """
+    @params
+        model: current weights
+        i: iteration, part of the worker seeds
+
+    @return
+        same as collect_trajs, copied out of the shared buffers or views of the store slot
+    """
+    def collect(self, model, i):
+        n = None if self.store is None else self.store.next_slot()[0]
+        slot = self.buffers if n is None else self.store.slot(n)
+
+        if self.params["env"] == "car":
+            self._run("start", i, n)
+            deltas = model_deltas(model, slot["tasks"].clone(), slot["x0s"].clone(), self.params, i)
+            self.buffers["deltas"].copy_(deltas.detach())
+            self._run("rollout", i, n)
+        else:
+            self.model.load_state_dict(model.state_dict())
+            self._run("collect", i, n)
+            deltas = model_deltas(model, slot["tasks"].clone(), slot["x0s"].clone(), self.params, i)
+
+        if self.store is not None:
+            self.store.append(i)
+            return self.store.load(n) + (deltas,)
+
+        return (self.buffers["residuals"].clone(), list(self.buffers["x0s"].clone()),
+                list(self.buffers["tasks"].clone()), list(self.buffers["points"].clone()), deltas)
+
+    def close(self):
+        for commands in self.commands:
+            commands.put(None)
+        for proc in self.procs:
+            proc.join()
+
+def _actor(params, model, lock, version, buffers, free_slots, ready, store, seed):
+    torch.set_num_threads(1)
+    try:
+        env = make_env(params)
+        controller = make_controller(params)
+        local_model = copy.deepcopy(model)
+    except Exception:
+        ready.put((None, None, traceback.format_exc(), {}))
+        return
+    timer.take() #drop phases inherited from the parent
+
+    slots = buffers["residuals"].shape[0]
+    for i in range(params["iterations"]):
+        free_slots.acquire()
+        with lock:
+            local_model.load_state_dict(model.state_dict())
+            used = version.value
+
+        try:
+            np.random.seed([seed, i])
+            torch.manual_seed(seed*1000003 + i)
+
+            with torch.no_grad(), timer.phase("collect"):
+                residuals, x0s, tasks, points_set, _ = collect_trajs(local_model, env, controller, params, i, store)
+                for name, values in zip(["residuals", "x0s", "tasks", "points"], [residuals, x0s, tasks, points_set]):
+                    buffers[name][i % slots].copy_(values if torch.is_tensor(values) else torch.stack(values))
+            ready.put((i, used, None, timer.take()))
+        except Exception:
+            ready.put((i, used, traceback.format_exc(), timer.take()))
+            return
+
+class Async_actor:
+    """
+    Description:
+        Collects the trajectories of the next iterations in a background process while
+        the learner backpropagates the current one. The actor uses the weights last
+        published by the learner, which are at most max_staleness optimizer steps behind
+        the weights they are trained with: results go through a ring of max_staleness + 1
+        shared-memory slots and a slot is only reused after the learner published past it.
+        max_staleness = 0 collects strictly one iteration after the other.
+        Actor RNGs are seeded from (seed, iteration). The actor times its collection of
+        every iteration, get adds it to the learner's timer
+    """
+    def __init__(self, model, params, max_staleness=1, seed=0, store=None):
+        ctx = mp.get_context("fork")
+
+        slots = max_staleness + 1
+        steps = len(np.arange(0, params["horizon"] + params["dt"], params["dt"]))
+        state_dim = state_dims[params["env"]]
+        num_points = params["points_per_sec"]*params["horizon"]
+
+        self.model = copy.deepcopy(model).share_memory()
+        self.buffers = {"residuals": torch.zeros(slots, params["trajs"], steps, state_dim).share_memory_(),
+                        "x0s": torch.zeros(slots, params["trajs"], state_dim).share_memory_(),
+                        "tasks": torch.zeros(slots, params["trajs"], 2*params["horizon"]).share_memory_(),
+                        "points": torch.zeros(slots, params["trajs"], 2*num_points).share_memory_()}
+
+        self.lock = ctx.Lock()
+        self.version = ctx.Value("i", 0)
+        self.free_slots = ctx.Semaphore(slots)
+        self.ready = ctx.Queue()
+        self.proc = ctx.Process(target=_actor, args=(params, self.model, self.lock, self.version, self.buffers, self.free_slots, self.ready, store, seed), daemon=True)
+        self.proc.start()
+
+    """
+    @params
+        i: iteration the learner is at, the actor collects iterations in order
+
+    @return
+        residuals, x0s, tasks, points_set of iteration i, views of the slot that stay valid until publish
+        staleness: optimizer steps between the weights used to collect and the current ones
+    """
+    def get(self, i):
+        collected, used, error, phases = self.ready.get()
+        timer.add([phases])
+        if error is not None:
+            raise RuntimeError("Trajectory collection failed in actor:\n{}".format(error))
+        assert collected == i, "Actor collected iteration {}, learner is at {}".format(collected, i)
+
+        s = i % self.buffers["residuals"].shape[0]
+        return (self.buffers["residuals"][s], list(self.buffers["x0s"][s]), list(self.buffers["tasks"][s]),
+                list(self.buffers["points"][s]), self.version.value - used)
+
+    """
+    Hands the updated weights to the actor and frees the slot of the last get
+
+    @params
+        model: weights after optimizer.step
+    """
+    def publish(self, model):
+        with self.lock:
+            self.model.load_state_dict(model.state_dict())
+            self.version.value += 1
+        self.free_slots.release()
+
+    def close(self):
+        if self.proc.is_alive():
+            self.proc.terminate()
+        self.proc.join()
@@ -0,0 +1,57 @@
+import importlib
+import torch
+
+"""
+Environments and controllers by params["env"], as (module, class) names that are only
+imported when that env is made. A car run never imports the A1 simulator (pybullet),
+and nothing here imports matplotlib
+"""
+envs = {"car": ("dubins_env", "Dubins_env"),
+        "a1": ("a1_learning_hierarchical.motion_imitation.envs.a1_env", "A1GymEnv")}
+
+controllers = {"car": ("dubins_controller", "Dubins_controller"),
+               "a1": ("a1_controller", "A1_controller")}
+
+# Constructor arguments from the run params
+env_kwargs = {"car": lambda params: {"f_v": params["dubins_dyn_coeffs"][0], "f_phi": params["dubins_dyn_coeffs"][1], "scale": params["dubins_dyn_coeffs"][2],
+                                     "v0": params["dubins_dyn_coeffs"][3], "phi0": params["dubins_dyn_coeffs"][4]},
+              "a1": lambda params: {}}
+
+controller_weights = {"car": "dubins_controller_weights", "a1": "a1_controller_weights"}
+
+def _load(table, env):
+    if env not in table:
+        raise NotImplementedError("Environment not implemented")
+    module, name = table[env]
+    return getattr(importlib.import_module(module), name)
+
+def env_class(env):
+    return _load(envs, env)
+
+def controller_class(env):
+    return _load(controllers, env)
+
+"""
+@params
+    params: run params, "env" selects the entry
+
+@return
+    new env over params["horizon"] seconds with step params["dt"]
+"""
+def make_env(params):
+    cls = env_class(params["env"])
+    return cls(total_time=params["horizon"], dt=params["dt"], **env_kwargs[params["env"]](params))
+
+"""
+@params
+    params: run params, "env" selects the entry
+    weights: controller gains, None uses the gains in params
+
+@return
+    new controller
+"""
+def make_controller(params, weights=None):
+    cls = controller_class(params["env"])
+    if weights is None:
+        weights = torch.tensor(params[controller_weights[params["env"]]], dtype=torch.float)
+    return cls(weights)
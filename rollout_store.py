@@ -0,0 +1,123 @@
+import torch
+import numpy as np
+import json
+import os
+from helper import state_dims, action_dims
+
+
+class Rollout_store:
+    """
+    Description:
+        Collected rollouts of every iteration in preallocated memory-mapped .npy files,
+        one per field, with a leading [capacity] iteration axis. Appending an iteration
+        hands out zero-copy tensor views of the next free slot that collect_trajs writes
+        into, so nothing is copied or rebuilt. Files can be reopened with np.load(mmap_mode="r")
+        or Rollout_store(path) for reuse and analysis
+
+        Fields (per slot):
+            obs, next_obs, residuals: [trajs, steps, state]
+            actions: [trajs, steps, action] (double, like the controllers)
+            x0s: [trajs, state], tasks: [trajs, 2*horizon], points: [trajs, 2*points]
+            iteration: training iteration the slot was collected at
+    """
+
+    traj_fields = ["residuals", "x0s", "tasks", "points"]
+
+    """
+    @params
+        path: directory of the store, created when params are given
+        params: run params, None opens an existing store
+        capacity: number of iterations the store holds
+        mode: np.memmap mode used to reopen an existing store
+    """
+    def __init__(self, path, params=None, capacity=None, mode="r+"):
+        self.path = path
+
+        if params is None:
+            with open(os.path.join(path, "meta.json")) as f:
+                self.meta = json.load(f)
+            self.arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mode) for name in self.meta["fields"]}
+            return
+
+        steps = len(np.arange(0, params["horizon"] + params["dt"], params["dt"]))
+        trajs = params["trajs"]
+        state = state_dims[params["env"]]
+        shapes = {"obs": ((trajs, steps, state), "float32"),
+                  "actions": ((trajs, steps, action_dims[params["env"]]), "float64"),
+                  "next_obs": ((trajs, steps, state), "float32"),
+                  "residuals": ((trajs, steps, state), "float32"),
+                  "x0s": ((trajs, state), "float32"),
+                  "tasks": ((trajs, 2*params["horizon"]), "float32"),
+                  "points": ((trajs, 2*params["points_per_sec"]*params["horizon"]), "float32"),
+                  "iteration": ((), "int64")}
+
+        os.makedirs(path, exist_ok=True)
+        self.arrays = {name: np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=dtype, shape=(capacity,) + shape)
+                       for name, (shape, dtype) in shapes.items()}
+        self.meta = {"fields": list(shapes), "capacity": capacity, "count": 0, "env": params["env"], "dt": params["dt"]}
+        self._write_meta()
+
+    def _write_meta(self):
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+
+    def __len__(self):
+        return self.meta["count"]
+
+    """
+    @params
+        n: slot index
+
+    @return
+        dict of field -> zero-copy tensor view of slot n, without iteration
+    """
+    def slot(self, n):
+        return {name: torch.from_numpy(array[n]) for name, array in self.arrays.items() if name != "iteration"}
+
+    """
+    @return
+        index and views of the next free slot, written by collect_trajs before append
+    """
+    def next_slot(self):
+        n = self.meta["count"]
+        if n >= self.meta["capacity"]:
+            raise RuntimeError("Rollout store is full ({} iterations)".format(self.meta["capacity"]))
+        return n, self.slot(n)
+
+    """
+    @params
+        i: training iteration the filled slot was collected at
+    """
+    def append(self, i):
+        n = self.meta["count"]
+        self.arrays["iteration"][n] = i
+        for array in self.arrays.values():
+            array.flush()
+        self.meta["count"] = n + 1
+        self._write_meta()
+
+    """
+    @params
+        n: slot index, negative counts from the last stored iteration
+
+    @return
+        residuals, x0s, tasks, points_set of slot n, like the first outputs of collect_trajs
+    """
+    def load(self, n=-1):
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError("Slot {} not in store of {} iterations".format(n, len(self)))
+
+        views = self.slot(n)
+        return views["residuals"], list(views["x0s"]), list(views["tasks"]), list(views["points"])
+
+    """
+    @return
+        slot index holding training iteration i
+    """
+    def find(self, i):
+        matches = np.nonzero(self.arrays["iteration"][:len(self)] == i)[0]
+        if len(matches) == 0:
+            raise KeyError("Iteration {} not in store".format(i))
+        return int(matches[-1])
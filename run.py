@@ -9,6 +9,10 @@ from dubins_controller import *
 from dubins_env import *
 from a1_controller import *
 from a1_env import *
+from unroll import batched_loss, serial_loss, make_step, Saved_tensor_meter
+from parallel import Collector_pool, Async_actor
+from rollout_store import Rollout_store
+from timers import timer
 import argparse
 import pdb
 from torch.utils.tensorboard import SummaryWriter
@@ -17,7 +21,6 @@ from tqdm import tqdm, trange
 import json
 import time
 import shutil
-from a1_learning_hierarchical.motion_imitation.envs.a1_env import A1GymEnv
 
 
 ######################### PARAMETER STUFF ######################
@@ -35,6 +38,15 @@ parser.add_argument('--loss_stride', type=float, default=10) # number of simulat
 parser.add_argument('--terminal_weight', type=float, default=10) 
 parser.add_argument('--controller_stride', type=float, default=10)
 parser.add_argument('--learn_weights', type=bool, default=False)
+parser.add_argument('--batched', action="store_true") #unroll all trajectories in lockstep when building the loss
+parser.add_argument('--compile_step', type=str, default=None) #fused rollout step for --batched: script, compile or eager
+parser.add_argument('--checkpoint_chunk', type=int, default=0) #steps per gradient checkpoint in the --batched unroll, 0 keeps the whole graph
+parser.add_argument('--backward_batch', type=int, default=0) #trajectories per backward pass, gradients are accumulated over the batches, 0 runs one backward over all trajectories
+parser.add_argument('--workers', type=int, default=0) #processes collecting trajectories in parallel, 0 collects in this process
+parser.add_argument('--store_rollouts', action="store_true") #keep every iteration's rollouts memory-mapped in <logdir>/rollouts, needs --run_name
+parser.add_argument('--async_actor', action="store_true") #collect the next iterations in a background process while backpropagating the current one
+parser.add_argument('--max_staleness', type=int, default=1) #optimizer steps the --async_actor weights may lag behind
+parser.add_argument('--seed', type=int, default=0) #base seed of the collection workers
 
 parser.add_argument('--dubins_controller_weights', type=list, default=[3, 3, 3, 3])
 parser.add_argument('--dubins_dyn_coeffs', type=list, default=[0.5, 0.25, 0.95, 0, 0]) #friction on v, phi, scale on inputs, init v between [0, v0] and phi between [-phi0, phi0]
@@ -86,11 +98,6 @@ num_output_states = 2*params["points_per_sec"]*params["horizon"]
 if params["env"] == "car":
     f_nominal = nominals["car"]
     weights = torch.tensor(params["dubins_controller_weights"], dtype=torch.float)
-    coeffs = params["dubins_dyn_coeffs"]
-
-    controller = Dubins_controller(weights)
-    env = Dubins_env(total_time=params["horizon"], dt=params["dt"], f_v=coeffs[0], f_phi=coeffs[1], scale=coeffs[2],
-                    v0=coeffs[3], phi0=coeffs[4])
 
     num_input_states = 2*params["horizon"] + 2 #v0 and phi0
     if params["learn_weights"]:
@@ -100,10 +107,6 @@ elif params["env"] == "a1":
     f_nominal = nominals["a1"]
     weights = torch.tensor(params["a1_controller_weights"], dtype=torch.float)
 
-    controller = A1_controller(weights)
-    env = A1GymEnv(total_time=params["horizon"], dt=params["dt"])
-    #env = A1_env(total_time=params["horizon"], dt=params["dt"])
-
     num_input_states = 2*params["horizon"] + 3 #v0 and phi0 and phid0
     if params["learn_weights"]:
         num_output_states += 5
@@ -111,14 +114,46 @@ elif params["env"] == "a1":
 else:
     raise NotImplementedError("Environment not implemented")
 
+controller = make_controller(params, weights)
+
 #################### NEURAL NETWORK SETUP ##########################
 # Input: [x0, x1, ..., y0, y1, ..., v0, phi0]
 # Output: Deltas on the above
 # make_model in helper.py
 model = make_model([num_input_states, 32, 32, num_output_states])
 
-#Times the model affects
-output_times = np.linspace(0, params["horizon"], params["points_per_sec"]*params["horizon"] + 1)
+# The fused step and the gradient checkpoints are part of the --batched unroll
+for flag in ["compile_step", "checkpoint_chunk"]:
+    if params[flag] and not params["batched"]:
+        raise ValueError("--{} only applies to the --batched unroll, run it with --batched".format(flag))
+
+# Rollouts of every iteration, created before the workers so they share the mapping
+store = None
+if params["store_rollouts"]:
+    if not log:
+        raise ValueError("--store_rollouts needs a --run_name to store the rollouts in")
+    store = Rollout_store(os.path.join(logdir, "rollouts"), params, params["iterations"])
+
+# Trajectory collection, in a background actor with --async_actor or in worker processes that own their env when --workers > 0
+if params["async_actor"]:
+    if params["workers"] > 0:
+        raise ValueError("--async_actor collects in a single background process, run it without --workers")
+    actor = Async_actor(model, params, params["max_staleness"], params["seed"], store)
+elif params["workers"] > 0:
+    pool = Collector_pool(model, params, params["workers"], params["seed"], store)
+else:
+    env = make_env(params)
+
+backward_batch = params["backward_batch"] or params["trajs"]
+step_fn = make_step(params["env"], params["compile_step"]) if params["compile_step"] else None
+
+sim_steps = params["trajs"]*len(np.arange(0, params["horizon"] + params["dt"], params["dt"]))
+if params["env"] == "a1":
+    # Every A1 trajectory starts with a warm-up, which is part of the collect time
+    sim_steps += params["trajs"]*len(np.arange(0, params["a1_warm_up_time"], params["dt"]))
+
+# Workers and the actor time the simulation themselves and report it as collect, the learner only waits for it
+collect_phase = "collect_wait" if params["async_actor"] or params["workers"] > 0 else "collect"
 
 #################### TRAINING LOOP ##################################
 optimizer = optim.Adam(model.parameters(), lr=params["lr"])
@@ -127,68 +162,86 @@ best_loss = np.inf
 prog_bar = trange(params["iterations"], leave=True)
 for i in prog_bar:
 
+    timer.start_iteration()
     optimizer.zero_grad() 
 
     # Collect trajectories (helper.py)
-    dynamics, x0s, tasks, points_set = collect_trajs(model, env, controller, params, i)
-
-    # Construct loss function
-    loss = 0
-    for (dyn, x0, task, points) in zip(dynamics, x0s, tasks, points_set):
-        x = x0
-
-        def f(x,u,t): 
-            return f_nominal(x,u,params["dt"]) + dyn[t][2] - f_nominal(dyn[t][0],dyn[t][1],params["dt"]).detach()
-
-        deltas = model(model_input(task, x0, params))*params["model_scale"]*(min(1, 2*(i+1)/params["iterations"]))
-
-        task_deltas = deltas[:2*params["points_per_sec"]*params["horizon"]]
-
-        if params["learn_weights"]:
-            controller_deltas = deltas[2*params["points_per_sec"]*params["horizon"]:]
-            if params["env"] == "car":
-                controller = Dubins_controller(weights + controller_deltas)
-            elif params["env"] == "a1":
-                controller = A1_controller(weights + controller_deltas)
-
-        task_adj = points + task_deltas
-        spline = Spline(task_adj[:params["horizon"]*params["points_per_sec"]], task_adj[params["horizon"]*params["points_per_sec"]:], times=output_times, init_pos=x0)
-
-        j = 0
-        for t in np.arange(0, params["horizon"] + params["dt"], params["dt"]):
-            if (j % params["controller_stride"] == 0): 
-                u, des_pos, act_pos= controller.next_action(t, spline, x)
-
-            if (j % params["loss_stride"] == 0):
-                loss += cost(x, u, t, task, params, x0)
-                
-            x = f(x, u, int(t/params["dt"]))
-
-            j += 1
+    with timer.phase(collect_phase):
+        if params["async_actor"]:
+            residuals, x0s, tasks, points_set, staleness = actor.get(i)
+            deltas = model_deltas(model, torch.stack(tasks), torch.stack(x0s), params, i)
+        elif params["workers"] > 0:
+            residuals, x0s, tasks, points_set, deltas = pool.collect(model, i)
+        else:
+            residuals, x0s, tasks, points_set, deltas = collect_trajs(model, env, controller, params, i, store)
+
+    # Construct loss function, backpropagating every backward_batch trajectories so only one graph is alive at a time
+    # The batches backpropagate into a detached copy of the model output, which is backpropagated through the model once
+    deltas_leaf = deltas.detach().requires_grad_()
+    loss_total = 0
+    graph_bytes = 0
+    for start in range(0, params["trajs"], backward_batch):
+        batch = slice(start, start + backward_batch)
+        with Saved_tensor_meter() as graph_meter, timer.phase("unroll"):
+            if params["batched"]:
+                loss = batched_loss(deltas_leaf[batch], residuals[batch], x0s[batch], tasks[batch], points_set[batch], params, weights, step_fn=step_fn, checkpoint_chunk=params["checkpoint_chunk"], meter=graph_meter)
+            else:
+                loss = serial_loss(deltas_leaf[batch], residuals[batch], x0s[batch], tasks[batch], points_set[batch], params, weights, controller)
+
+        # Backprop, gradients accumulate over the batches
+        with timer.phase("backward"):
+            loss.backward()
+        # Checkpointed chunks are recomputed during backward, so their share of the peak is only known now
+        graph_bytes = max(graph_bytes, graph_meter.peak)
+        loss_total += loss.item()
+    with timer.phase("backward"):
+        deltas.backward(deltas_leaf.grad)
 
     # Checkpoint
-    loss_avg = loss.item() / (params["trajs"])
+    loss_avg = loss_total / (params["trajs"])
     if log: 
         loss_file.write(str(loss_avg) + "\n")
         writer.add_scalar("Loss/Train", loss_avg, i)
+        writer.add_scalar("Memory/saved_tensors_peak_mb", graph_bytes/1e6, i)
+        if params["async_actor"]:
+            writer.add_scalar("Async/staleness", staleness, i)
 
         if (i % params["save_every"] == 0) and (i != 0):
-            torch.save(model, os.path.join(logdir, "model_{}.pt".format(i)))
-            if loss_avg < best_loss:
-                torch.save(model, os.path.join(logdir, "best_model.pt"))
-                best_loss = loss_avg
-
+            with timer.phase("save"):
+                torch.save(model, os.path.join(logdir, "model_{}.pt".format(i)))
+                if loss_avg < best_loss:
+                    torch.save(model, os.path.join(logdir, "best_model.pt"))
+                    best_loss = loss_avg
 
-    # Backprop
-    loss.retain_grad()
-    loss.backward(retain_graph=True)
     optimizer.step()
+    if params["async_actor"]:
+        actor.publish(model)
 
-    prog_bar.set_description("Loss: {}".format(loss_avg), refresh=True)
+    times = timer.end_iteration()
+    if log:
+        for name, seconds in times.items():
+            writer.add_scalar("Time/{}_s".format(name), seconds, i)
+        writer.add_scalar("Time/sim_steps_per_sec", sim_steps / times["collect"], i)
+
+    prog_bar.set_description("Loss: {} Graph: {:.3f}MB".format(loss_avg, graph_bytes/1e6), refresh=True)
 
 
 ########################### FINAL LOGGING STUFF ###########################
+if params["async_actor"]:
+    actor.close()
+elif params["workers"] > 0:
+    pool.close()
+
+timing = timer.summary()
+timing["sim_steps_per_sec"] = sim_steps*timing["iterations"] / timing["phases"]["collect"]["total_s"]
+print("{:<12} {:>10} {:>12} {:>7}".format("phase", "total s", "per iter s", "share"))
+for name, phase in timing["phases"].items():
+    print("{:<12} {:>10.2f} {:>12.3f} {:>6.1f}%".format(name, phase["total_s"], phase["mean_s"], 100*phase["share"]))
+print("Simulation steps per second: {:.0f}".format(timing["sim_steps_per_sec"]))
+
 if log:
+    with open(os.path.join(logdir, "timing.json"), "w") as outfile:
+        json.dump(timing, outfile, indent=2)
     writer.close()
     loss_file.close()
     if loss_avg < best_loss:
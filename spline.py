@@ -3,19 +3,256 @@
 """
 from scipy import interpolate
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
 import torch
+import functools
+import numbers
+import bisect
 import pdb
 
+def _as_double(v):
+    if torch.is_tensor(v):
+        return v.double()
+    return torch.tensor(np.asarray(v, dtype=np.float64))
+
+def _tridiagonal_solve(lower, diag, upper, rhs):
+    """
+    Thomas algorithm along the last dimension of rhs
+    lower, diag, upper only depend on the knot times so they are swept in numpy,
+    rhs is a (possibly batched) tensor and stays differentiable
+    """
+    m = len(diag)
+    c_prime = np.zeros(m)
+    denom = np.zeros(m)
+
+    denom[0] = diag[0]
+    c_prime[0] = upper[0] / denom[0]
+    for i in range(1, m):
+        denom[i] = diag[i] - lower[i]*c_prime[i-1]
+        c_prime[i] = upper[i] / denom[i]
+
+    d = [rhs[..., 0] / denom[0]]
+    for i in range(1, m):
+        d.append((rhs[..., i] - lower[i]*d[-1]) / denom[i])
+
+    sol = [d[-1]]
+    for i in reversed(range(m - 1)):
+        sol.append(d[i] - c_prime[i]*sol[-1])
+
+    return torch.stack(sol[::-1], dim=-1)
+
+def _fit_banded(times, coords, vel_0, vel_f):
+    """
+    Clamped cubic spline through (times[0], 0), (times[1], coords[..., 0]), ...
+    with end velocities vel_0 and vel_f, solved for the knot slopes in O(n)
+
+    @return
+        coefficients [..., n-1, 4] of a*t^3 + b*t^2 + c*t + d in absolute time,
+        same layout as the dense solver
+    """
+    times = np.asarray(times, dtype=np.float64)
+    h = np.diff(times)
+    t0 = torch.from_numpy(times[:-1])
+    h_t = torch.from_numpy(h)
+
+    y = torch.cat((torch.zeros_like(coords[..., :1]), coords), dim=-1)
+    delta = (y[..., 1:] - y[..., :-1]) / h_t
+
+    vel_0 = vel_0.expand(coords.shape[:-1]).unsqueeze(-1)
+    vel_f = vel_f.expand(coords.shape[:-1]).unsqueeze(-1)
+
+    if len(h) > 1:
+        inv_h = 1 / h
+        diag = 2*(inv_h[:-1] + inv_h[1:])
+        lower = np.concatenate(([0], inv_h[1:-1]))
+        upper = np.concatenate((inv_h[1:-1], [0]))
+
+        first = np.zeros(len(diag))
+        first[0] = inv_h[0]
+        last = np.zeros(len(diag))
+        last[-1] = inv_h[-1]
+
+        rhs = 3*(delta[..., :-1]*torch.from_numpy(inv_h[:-1]) + delta[..., 1:]*torch.from_numpy(inv_h[1:]))
+        rhs = rhs - vel_0*torch.from_numpy(first) - vel_f*torch.from_numpy(last)
+
+        slopes = torch.cat((vel_0, _tridiagonal_solve(lower, diag, upper, rhs), vel_f), dim=-1)
+    else:
+        slopes = torch.cat((vel_0, vel_f), dim=-1)
+
+    m_0 = slopes[..., :-1]
+    m_1 = slopes[..., 1:]
+
+    # local cubic in s = t - t0
+    c2 = (3*delta - 2*m_0 - m_1) / h_t
+    c3 = (m_0 + m_1 - 2*delta) / h_t**2
+
+    a = c3
+    b = c2 - 3*c3*t0
+    c = m_0 - 2*c2*t0 + 3*c3*t0**2
+    d = y[..., :-1] - m_0*t0 + c2*t0**2 - c3*t0**3
+
+    return torch.stack((a, b, c, d), dim=-1)
+
+def _segments(times, ts):
+    """
+    Index i of the cubic with times[i] < t <= times[i+1] (the first one at t = times[0],
+    the last one past the end), found by binary search
+    """
+    if isinstance(ts, numbers.Real):
+        #single time, as the controllers pass every tick: bisect on a list gives a plain int index
+        knots = times if isinstance(times, list) else list(times)
+        return min(max(bisect.bisect_left(knots, ts) - 1, 0), len(knots) - 2)
+    if torch.is_tensor(ts):
+        idx = torch.searchsorted(torch.as_tensor(times, dtype=ts.dtype, device=ts.device), ts.detach().contiguous()) - 1
+        return torch.clamp(idx, 0, len(times) - 2)
+    return np.clip(np.searchsorted(times, ts) - 1, 0, len(times) - 2)
+
+def _end_slope(times, coords):
+    return (coords[..., -1] - coords[..., -2]) / (times[-1] - times[-2])
+
+@functools.lru_cache(maxsize=32)
+def _fit_operator(times, clamped):
+    """
+    The fit is linear in [coords..., vel_0(, vel_f)] for a fixed knot grid, so it is
+    solved once per (times, boundary mode) on the identity and reused as a matrix
+    times: tuple of knot times
+    clamped: vel_f is given, otherwise it is the slope of the last two knots
+
+    @return
+        [4(n-1), n-1 + 1(+1)] double tensor, least recently used grids are evicted
+    """
+    n = len(times)
+    basis = torch.eye(n + 1 if clamped else n, dtype=torch.double)
+    coords = basis[:, :n-1]
+    vel_0 = basis[:, n-1]
+    vel_f = basis[:, n] if clamped else _end_slope(times, coords)
+
+    return _fit_banded(times, coords, vel_0, vel_f).reshape(len(basis), -1).T.contiguous()
+
+class Spline_function(torch.autograd.Function):
+    """
+    Description:
+        values [..., k] -> values @ operator.T for a cached spline operator, either the fit
+        (knot coordinates and boundary velocities to coefficients) or the fused fit and
+        evaluation. The map is linear so the backward is its adjoint, grad @ operator,
+        recorded as a single node instead of the per-element graph of the old fit
+    """
+    @staticmethod
+    def forward(ctx, values, operator):
+        ctx.save_for_backward(operator)
+        return torch.matmul(values, operator.T)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        operator, = ctx.saved_tensors
+        return torch.matmul(grad_output, operator), None
+
+def _boundary_values(coords, vel_0, vel_f):
+    values = [coords, vel_0.expand(coords.shape[:-1]).unsqueeze(-1)]
+    if vel_f is not None:
+        values.append(vel_f.expand(coords.shape[:-1]).unsqueeze(-1))
+    return torch.cat(values, dim=-1)
+
+def _fit(times, coords, vel_0, vel_f, solver):
+    """
+    coords: [..., n-1] double, vel_0 and vel_f double scalars or [...]
+    vel_f None ends the spline with the slope of the last two knots
+
+    @return
+        coefficients [..., n-1, 4]
+    """
+    if solver == "operator":
+        operator = _fit_operator(tuple(np.asarray(times, dtype=np.float64).tolist()), vel_f is not None)
+        return Spline_function.apply(_boundary_values(coords, vel_0, vel_f), operator).reshape(coords.shape[:-1] + (len(times) - 1, 4))
+    elif solver == "banded":
+        if vel_f is None:
+            vel_f = _end_slope(times, coords)
+        return _fit_banded(times, coords, vel_0, vel_f)
+    else:
+        raise NotImplementedError("Solver not implemented")
+
+def _sample_coeffs(times, coeffs, ts):
+    """
+    coeffs: [..., n-1, 4] cubic coefficients on the knot grid times
+    ts: times to evaluate at, shape [T]
+
+    @return
+        pos, vel, acc: [..., T]
+    """
+    if not torch.is_tensor(ts):
+        ts = torch.as_tensor(np.asarray(ts, dtype=np.float64))
+    ts = ts.to(coeffs.dtype)
+
+    seg = coeffs[..., _segments(times, ts), :]
+    a = seg[..., 0]
+    b = seg[..., 1]
+    c = seg[..., 2]
+    d = seg[..., 3]
+
+    pos = a*ts**3 + b*ts**2 + c*ts + d
+    vel = 3*a*ts**2 + 2*b*ts + c
+    acc = 6*a*ts + 2*b
+
+    return pos, vel, acc
+
+@functools.lru_cache(maxsize=32)
+def _sample_operator(times_key, ts_key, clamped):
+    """
+    Fit followed by evaluation at the fixed times ts as one matrix
+    times_key, ts_key: float64 bytes of the knot times and sample times
+
+    @return
+        [3*T, n-1 + 1(+1)] double tensor, rows are positions, velocities then accelerations
+    """
+    times = np.frombuffer(times_key).copy()
+    ts = np.frombuffer(ts_key).copy()
+    fit = _fit_operator(tuple(times.tolist()), clamped)
+
+    pos, vel, acc = _sample_coeffs(times, fit.T.reshape(fit.shape[1], len(times) - 1, 4), ts)
+
+    return torch.cat((pos, vel, acc), dim=-1).T.contiguous()
+
+def sample_spline(x_coords, y_coords, ts, xd_0=0, yd_0=0, xd_f=None, yd_f=None, times=None, init_pos=None):
+    """
+    Same values as Batch_spline(...).sample(ts), but fitting and evaluation go through one
+    cached operator and one Spline_function node per coordinate
+    x_coords, y_coords: [..., n-1]
+    ts: array of times, part of the cache key
+
+    @return
+        pos, vel, acc: [..., T, 2]
+    """
+    x_coords = _as_double(x_coords)
+    y_coords = _as_double(y_coords)
+
+    if times is None:
+        times = np.arange(x_coords.shape[-1] + 1)
+
+    times_key = np.ascontiguousarray(times, dtype=np.float64).tobytes()
+    ts_key = np.ascontiguousarray(ts, dtype=np.float64).tobytes()
+
+    res = []
+    for coords, vel_0, vel_f in ((x_coords, xd_0, xd_f), (y_coords, yd_0, yd_f)):
+        vel_f = None if vel_f is None else _as_double(vel_f)
+        operator = _sample_operator(times_key, ts_key, vel_f is not None)
+        res.append(Spline_function.apply(_boundary_values(coords, _as_double(vel_0), vel_f), operator).reshape(coords.shape[:-1] + (3, -1)))
+    res = torch.stack(res, dim=-1)
+
+    if init_pos is not None:
+        res = res + init_pos[..., :2].unsqueeze(-2).unsqueeze(-2)
+
+    return res[..., 0, :, :], res[..., 1, :, :], res[..., 2, :, :]
+
 class Spline():
     """
     Cubic Spline Interpolation
     x_coord, y_coord positions at t >=1
     xd, yd are the velocities (initial and final)
     times by default assume a second between each of the coords
+    solver: "operator" applies the fit matrix cached for this knot grid (one matmul),
+            "banded" solves the tridiagonal system for the knot slopes in O(n),
+            "dense" inverts the full 4(n-1) x 4(n-1) system (reference)
     """
-    def __init__(self, x_coord, y_coord, xd_0=0, yd_0=0, xd_f=None, yd_f=None, times=None, init_pos=torch.tensor([0, 0], dtype=torch.float)):
+    def __init__(self, x_coord, y_coord, xd_0=0, yd_0=0, xd_f=None, yd_f=None, times=None, init_pos=torch.tensor([0, 0], dtype=torch.float), solver="operator"):
 
         if times is None:
             times = np.arange(len(x_coord) + 1)
@@ -25,14 +262,32 @@ class Spline():
         assert n == len(y_coord) + 1, "lengths don't match"
         assert n >= 2, "not long enough"
 
-        if xd_f==None:
-            xd_f = (x_coord[-1] - x_coord[-2]) / (times[-1] - times[-2])
+        self.times = times
+        self.knots = [float(t) for t in times]
 
-        if yd_f==None:
-            yd_f = (y_coord[-1] - y_coord[-2]) / (times[-1] - times[-2])
+        self.init_x = init_pos[0]
+        self.init_y = init_pos[1]
+
+        if solver == "dense":
+            if xd_f==None:
+                xd_f = (x_coord[-1] - x_coord[-2]) / (times[-1] - times[-2])
+
+            if yd_f==None:
+                yd_f = (y_coord[-1] - y_coord[-2]) / (times[-1] - times[-2])
+
+            self._fit_dense(x_coord, y_coord, xd_0, yd_0, xd_f, yd_f)
+        else:
+            self.coeffs_x = _fit(times, _as_double(x_coord), _as_double(xd_0), None if xd_f is None else _as_double(xd_f), solver).reshape(-1)
+            self.coeffs_y = _fit(times, _as_double(y_coord), _as_double(yd_0), None if yd_f is None else _as_double(yd_f), solver).reshape(-1)
+
+    def _fit_dense(self, x_coord, y_coord, xd_0, yd_0, xd_f, yd_f):
+        """
+        Reference solver: builds the full 4(n-1) x 4(n-1) system and inverts it
+        O(n^3), kept to check the banded solver against
+        """
+        times = self.times
+        n = len(times)
 
-        self.times = times
-        
         row_length = 4 * (n-1)
 
         self.A_x = []
@@ -41,9 +296,6 @@ class Spline():
         self.b_x = torch.zeros(4*(n-1), dtype=torch.double)
         self.b_y = torch.zeros(4*(n-1), dtype=torch.double)
 
-        self.init_x = init_pos[0]
-        self.init_y = init_pos[1]
-
         j=0 #index for b vectors
 
         for i in np.arange(n):
@@ -158,21 +410,10 @@ class Spline():
     def evaluate(self, t, der=0):
 
         #Find which cubic funtion to use
-        if t == 0:
-            i = 0
-        else:
-            diff = self.times - t
-            i = np.where(diff<0)[0][-1]
-
-        a_x = self.coeffs_x[4*i]
-        b_x = self.coeffs_x[4*i + 1]
-        c_x = self.coeffs_x[4*i + 2]
-        d_x = self.coeffs_x[4*i + 3]
+        i = _segments(self.knots, t)
 
-        a_y = self.coeffs_y[4*i]
-        b_y = self.coeffs_y[4*i + 1]
-        c_y = self.coeffs_y[4*i + 2]
-        d_y = self.coeffs_y[4*i + 3]
+        a_x, b_x, c_x, d_x = self.coeffs_x[4*i:4*i + 4].unbind()
+        a_y, b_y, c_y, d_y = self.coeffs_y[4*i:4*i + 4].unbind()
 
         if der==0:
             res_x = a_x*t**3 + b_x*t**2 + c_x*t + d_x
@@ -186,25 +427,113 @@ class Spline():
 
         return res_x + self.init_x, res_y + self.init_y
 
+    def sample(self, ts):
+        """
+        Evaluates the spline at every time in ts in one pass
 
-if __name__=="__main__":
-    cs = Spline([1, 2], [1, 0], xd_0=1, yd_0=0)
-    cs.update([1, 4], [1, 2])
-    cs.update([1, 8], [1, 1])
-    times = np.linspace(0, 2, 80)
+        @params
+            ts: array or tensor of times
 
-    xs = []
-    ys = []
+        @return
+            pos, vel, acc: [len(ts), 2] tensors, offset by init_pos the same way evaluate is
+        """
+        coeffs = torch.stack((self.coeffs_x.reshape(-1, 4), self.coeffs_y.reshape(-1, 4)))
+        pos, vel, acc = _sample_coeffs(self.times, coeffs, ts)
+        init = torch.stack((torch.as_tensor(self.init_x), torch.as_tensor(self.init_y))).unsqueeze(-1)
 
-    for time in times:
-        x, y = cs.evaluate(time)
-        xs.append(x)
-        ys.append(y)
+        return (pos + init).T, (vel + init).T, (acc + init).T
 
-    plt.plot(xs, ys)
-    plt.show()
+class Batch_spline():
+    """
+    B cubic splines sharing one knot grid, fitted and evaluated as one tensor
+    x_coords, y_coords: [B, n-1] positions at times[1:]
+    xd, yd are the velocities (initial and final), scalars or [B]
+    init_pos: [B, >=2], only the first two entries are used
+    solver: "operator" or "banded", see Spline
+    coeffs_x, coeffs_y: [B, n-1, 4] in the same layout as Spline
+    """
+    def __init__(self, x_coords, y_coords, xd_0=0, yd_0=0, xd_f=None, yd_f=None, times=None, init_pos=None, solver="operator"):
+
+        x_coords = _as_double(x_coords)
+        y_coords = _as_double(y_coords)
+
+        if times is None:
+            times = np.arange(x_coords.shape[-1] + 1)
+
+        n = len(times)
+        assert x_coords.shape == y_coords.shape, "shapes don't match"
+        assert n == x_coords.shape[-1] + 1, "lengths don't match"
+        assert n >= 2, "not long enough"
+
+        self.times = times
 
+        if init_pos is None:
+            init_pos = torch.zeros(x_coords.shape[:-1] + (2,))
+        self.init_pos = init_pos[..., :2]
 
+        self.coeffs = torch.stack((_fit(times, x_coords, _as_double(xd_0), None if xd_f is None else _as_double(xd_f), solver),
+                                   _fit(times, y_coords, _as_double(yd_0), None if yd_f is None else _as_double(yd_f), solver)), dim=-3)
+        self.coeffs_x = self.coeffs[..., 0, :, :]
+        self.coeffs_y = self.coeffs[..., 1, :, :]
 
+    def evaluate(self, t, der=0):
+        """
+        t: scalar time or [T] times
+
+        @return
+            x, y: [B] for a scalar t, [B, T] otherwise
+        """
+        if torch.is_tensor(t):
+            scalar = t.dim() == 0
+            ts = t.reshape(-1)
+        else:
+            scalar = np.ndim(t) == 0
+            ts = np.atleast_1d(t)
+
+        res = _sample_coeffs(self.times, self.coeffs, ts)[der] + self.init_pos.unsqueeze(-1)
+
+        if scalar:
+            return res[..., 0, 0], res[..., 1, 0]
+        return res[..., 0, :], res[..., 1, :]
+
+    def sample(self, ts):
+        """
+        Evaluates all B splines at every time in ts in one pass
+
+        @return
+            pos, vel, acc: [B, len(ts), 2], offset by init_pos like Spline.sample
+        """
+        init = self.init_pos.unsqueeze(-1)
+        pos, vel, acc = _sample_coeffs(self.times, self.coeffs, ts)
 
+        return (pos + init).transpose(-1, -2), (vel + init).transpose(-1, -2), (acc + init).transpose(-1, -2)
 
+
+if __name__=="__main__":
+    import matplotlib.pyplot as plt
+
+    #banded solver and cached operator against the dense reference
+    times = np.array([0, 0.5, 1.5, 2, 3])
+    x_coord = torch.randn(4, dtype=torch.double)
+    y_coord = torch.randn(4, dtype=torch.double)
+    dense = Spline(x_coord, y_coord, xd_0=1, yd_0=0.5, times=times, solver="dense")
+    for solver in ["banded", "operator"]:
+        cs = Spline(x_coord, y_coord, xd_0=1, yd_0=0.5, times=times, solver=solver)
+        print(solver, "max coeff error x: ", torch.max(torch.abs(dense.coeffs_x - cs.coeffs_x)).item())
+        print(solver, "max coeff error y: ", torch.max(torch.abs(dense.coeffs_y - cs.coeffs_y)).item())
+
+    #analytic backward of the fused fit and evaluation
+    ts = np.linspace(0, 3, 13)
+    x_coord.requires_grad_()
+    print("gradcheck: ", torch.autograd.gradcheck(lambda x: sample_spline(x, y_coord, ts, xd_0=1, times=times)[0], (x_coord,)))
+    weights = torch.randn(len(ts), dtype=torch.double)
+    fused = torch.autograd.grad((sample_spline(x_coord, y_coord, ts, xd_0=1, times=times)[0][:, 0]*weights).sum(), x_coord)[0]
+    dense = Spline(x_coord, y_coord, xd_0=1, times=times, solver="dense")
+    reference = torch.autograd.grad((torch.stack([dense.evaluate(t)[0] for t in ts])*weights).sum(), x_coord)[0]
+    print("max grad error against dense: ", torch.max(torch.abs(fused - reference)).item())
+
+    cs = Spline([1, 2], [1, 0], xd_0=1, yd_0=0)
+    pos, _, _ = cs.sample(np.linspace(0, 2, 80))
+
+    plt.plot(pos[:, 0], pos[:, 1])
+    plt.show()
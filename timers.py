@@ -0,0 +1,79 @@
+import time
+import contextlib
+from collections import defaultdict
+
+
+class Phase_timer:
+    """
+    Description:
+        Wall time per named phase of a training iteration, kept for the current iteration
+        and summed over the run. Phases may nest (spline fitting inside collection), each
+        one is timed on its own. Only reads the clock, so it stays on in every run.
+        Collection workers and the async actor time their phases with their own copy
+        and send them to the learner with take, which adds them to its iteration
+    """
+    def __init__(self):
+        self.current = defaultdict(float)
+        self.totals = defaultdict(float)
+        self.iterations = 0
+        self.iteration_start = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.current[name] += elapsed
+            self.totals[name] += elapsed
+
+    def start_iteration(self):
+        self.current = defaultdict(float)
+        self.iteration_start = time.perf_counter()
+
+    """
+    @return
+        dict of phase -> seconds in this iteration, with the iteration wall time under "iteration"
+    """
+    def end_iteration(self):
+        elapsed = time.perf_counter() - self.iteration_start
+        self.current["iteration"] += elapsed
+        self.totals["iteration"] += elapsed
+        self.iterations += 1
+        return dict(self.current)
+
+    """
+    @return
+        dict of phase -> seconds timed since the last take, then cleared
+    """
+    def take(self):
+        phases = dict(self.current)
+        self.current = defaultdict(float)
+        return phases
+
+    """
+    Adds phases timed in other processes to the current iteration
+
+    @params
+        phases: list of dicts from take, one per process; the processes ran in parallel,
+            so each phase is counted with the slowest of them
+    """
+    def add(self, phases):
+        for name in set().union(*phases):
+            elapsed = max(process.get(name, 0) for process in phases)
+            self.current[name] += elapsed
+            self.totals[name] += elapsed
+
+    """
+    @return
+        per phase: total seconds, mean seconds per iteration and share of the iteration wall time
+    """
+    def summary(self):
+        wall = self.totals["iteration"]
+        return {"iterations": self.iterations,
+                "phases": {name: {"total_s": total, "mean_s": total / max(self.iterations, 1), "share": total / wall if wall else 0}
+                           for name, total in self.totals.items()}}
+
+# Shared by run.py and the helpers it calls, so phases inside collect_trajs or batched_loss are recorded without passing a timer around
+timer = Phase_timer()
@@ -0,0 +1,306 @@
+import torch
+import numpy as np
+import inspect
+import contextlib
+from typing import Tuple
+from torch.utils.checkpoint import checkpoint
+from spline import sample_spline
+from helper import *
+from timers import timer
+from controller_utils import desired_speed_heading
+from dubins_controller import Batch_dubins_controller
+from a1_controller import Batch_a1_controller
+
+batch_controllers = {"car": Batch_dubins_controller, "a1": Batch_a1_controller}
+
+# use_reentrant only exists from torch 1.11, reentrant checkpointing is what 1.10 always does
+checkpoint_kwargs = {"use_reentrant": True} if "use_reentrant" in inspect.signature(checkpoint).parameters else {}
+
+"""
+Fused rollout steps: controller law (when update_u), cost (when loss_step) and
+nominal dynamics plus the recorded residual, written with plain tensor ops so
+TorchScript / torch.compile can fuse them. Same math as Batch_*_controller,
+Tracking_cost.step and *_nominal_batch
+
+@params
+    x: [B, state], u: [B, action] last action
+    pos_d, vel_d: [B, 2] spline samples, gains: [controller gains] or [B, controller gains]
+    residual: [B, state], target: [B, 2], weight: terminal weight of this step
+
+@return
+    next state, action used, [B] cost (zeros when not loss_step)
+"""
+def car_step(x, u, pos_d, vel_d, gains, residual, target, weight, update_u: bool, loss_step: bool, input_weight: float, dt: float) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    if update_u:
+        v_des, phi_des = desired_speed_heading(pos_d, vel_d, x, gains[..., 0], gains[..., 1])
+
+        u = torch.stack((gains[..., 2]*(v_des - x[:, 2]), gains[..., 3]*(phi_des - x[:, 3])), dim=-1)
+
+    if loss_step:
+        cost = (((x[:, 0] - target[:, 0])**2 + (x[:, 1] - target[:, 1])**2) + (input_weight * (u[:, 0]**2 + u[:, 1]**2)))*weight
+    else:
+        cost = torch.zeros(x.shape[0], dtype=weight.dtype)
+
+    x_next = torch.stack((x[:, 0] + x[:, 2] * torch.cos(x[:, 3]) * dt,
+                          x[:, 1] + x[:, 2] * torch.sin(x[:, 3]) * dt,
+                          x[:, 2] + u[:, 0] * dt,
+                          x[:, 3] + u[:, 1] * dt), dim=-1).to(x.dtype)
+
+    return x_next + residual, u, cost
+
+def a1_step(x, u, pos_d, vel_d, gains, residual, target, weight, update_u: bool, loss_step: bool, input_weight: float, dt: float) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    if update_u:
+        v_des, phi_des = desired_speed_heading(pos_d, vel_d, x, gains[..., 0], gains[..., 1])
+
+        a = gains[..., 2]*(v_des - x[:, 2])
+        w_tilde = gains[..., 3]*(phi_des - x[:, 3])
+        theta = gains[..., 4]*(w_tilde - x[:, 4])
+
+        u = torch.stack((v_des, w_tilde, a, theta), dim=-1)
+
+    if loss_step:
+        cost = (((x[:, 0] - target[:, 0])**2 + (x[:, 1] - target[:, 1])**2) + (input_weight * (u[:, 0]**2 + u[:, 1]**2)))*weight
+    else:
+        cost = torch.zeros(x.shape[0], dtype=weight.dtype)
+
+    x_next = torch.stack((x[:, 0] + x[:, 2] * torch.cos(x[:, 3]) * dt,
+                          x[:, 1] + x[:, 2] * torch.sin(x[:, 3]) * dt,
+                          x[:, 2] + u[:, 0] * dt,
+                          x[:, 3] + x[:, 4] * dt,
+                          x[:, 4] + u[:, 1] * dt), dim=-1).to(x.dtype)
+
+    return x_next + residual, u, cost
+
+step_kernels = {"car": car_step, "a1": a1_step}
+
+def make_step(env, backend="script"):
+    """
+    Fused step for env compiled with backend: "script" (TorchScript), "compile"
+    (torch.compile) or "eager". Falls back to eager when the backend is not available
+    or fails on the first call
+    """
+    fn = step_kernels[env]
+
+    if backend == "eager":
+        return fn
+
+    try:
+        if backend == "script":
+            compiled = torch.jit.script(fn)
+        elif backend == "compile":
+            compiled = torch.compile(fn)
+        else:
+            raise NotImplementedError("Backend not implemented")
+    except NotImplementedError:
+        raise
+    except Exception as e:
+        print("Could not compile {} step with {} ({}), running eager".format(env, backend, e))
+        return fn
+
+    state = {"fn": compiled}
+    def step(*args):
+        try:
+            return state["fn"](*args)
+        except Exception as e:
+            if state["fn"] is fn:
+                raise
+            print("Compiled {} step failed ({}), running eager".format(env, e))
+            state["fn"] = fn
+            return fn(*args)
+
+    return step
+
+class Saved_tensor_meter:
+    """
+    Description:
+        Context manager adding up the bytes autograd saves for backward while it is
+        active, i.e. the memory the loss graph holds until loss.backward. A tensor saved
+        by several ops is counted once. Ops inside a checkpointed chunk save
+        nothing while the loss is built, the chunk graph is saved again when the chunk
+        is recomputed during backward, one chunk at a time: chunk() meters a recompute
+        and peak adds the largest one to the bytes held from the build
+    """
+    def __init__(self):
+        self.bytes = 0
+        self.chunk_bytes = 0
+        self.seen = set()
+
+    @property
+    def peak(self):
+        return self.bytes + self.chunk_bytes
+
+    @contextlib.contextmanager
+    def chunk(self):
+        chunk_meter = Saved_tensor_meter()
+        with chunk_meter:
+            yield
+        self.chunk_bytes = max(self.chunk_bytes, chunk_meter.bytes)
+
+    def _pack(self, tensor):
+        key = (tensor.data_ptr(), tensor.numel()*tensor.element_size())
+        if key not in self.seen:
+            self.seen.add(key)
+            self.bytes += key[1]
+        return tensor
+
+    def _unpack(self, tensor):
+        return tensor
+
+    def __enter__(self):
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, self._unpack)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
+
+def serial_loss(deltas, residuals, x0s, tasks, points_set, params, weights, controller):
+    """
+    Training loss of run.py without --batched, every trajectory unrolled on its own
+    with the controller objects
+
+    @params
+        deltas, residuals, x0s, tasks, points_set: output of collect_trajs
+        weights: controller gains the model deltas are added to when learn_weights
+        controller: base controller, used as is unless learn_weights
+
+    @return
+        loss summed over trajectories
+    """
+    f_nominal = nominals[params["env"]]
+    num_points = params["horizon"]*params["points_per_sec"]
+
+    #Times the model affects
+    output_times = np.linspace(0, params["horizon"], params["points_per_sec"]*params["horizon"] + 1)
+
+    loss = 0
+    for (residual, x0, task, points, deltas_traj) in zip(residuals, x0s, tasks, points_set, deltas):
+        x = x0
+
+        task_deltas = deltas_traj[:2*num_points]
+
+        # Local name, collection keeps using the base controller
+        traj_controller = controller
+        if params["learn_weights"]:
+            controller_deltas = deltas_traj[2*num_points:]
+            traj_controller = make_controller(params, weights + controller_deltas)
+
+        task_adj = points + task_deltas
+        with timer.phase("spline"):
+            spline = Spline(task_adj[:num_points], task_adj[num_points:], times=output_times, init_pos=x0)
+            task_cost = Tracking_cost(task, params, x0)
+
+        for j, t in enumerate(np.arange(0, params["horizon"] + params["dt"], params["dt"])):
+            if (j % params["controller_stride"] == 0):
+                u, _, _ = traj_controller.next_action(t, spline, x)
+
+            if (j % params["loss_stride"] == 0):
+                loss += task_cost.step(x, u, j)
+
+            x = f_nominal(x, u, params["dt"]) + residual[j]
+
+    return loss
+
+def batched_loss(deltas, residuals, x0s, tasks, points_set, params, weights, step_fn=None, checkpoint_chunk=None, meter=None):
+    """
+    Training loss of run.py with every trajectory unrolled in lockstep as [B, state] tensors
+    All splines are fitted and sampled together, so the Python loop is over time steps only
+
+    @params
+        deltas, residuals, x0s, tasks, points_set: output of collect_trajs
+        weights: controller gains the model deltas are added to
+        step_fn: fused step from make_step, None unrolls with the controller objects
+        checkpoint_chunk: steps per gradient checkpoint, None keeps the whole graph
+        meter: Saved_tensor_meter the chunk recomputes during backward are metered into
+
+    @return
+        loss summed over trajectories
+    """
+    f_nominal = batch_nominals[params["env"]]
+    dt = params["dt"]
+    num_points = params["horizon"]*params["points_per_sec"]
+
+    x0 = torch.stack(x0s)
+    tasks = torch.stack(tasks)
+    points = torch.stack(points_set)
+
+    task_deltas = deltas[:, :2*num_points]
+
+    if params["learn_weights"]:
+        gains = weights + deltas[:, 2*num_points:]
+    else:
+        gains = weights
+
+    task_adj = points + task_deltas
+
+    #Times the model affects
+    output_times = np.linspace(0, params["horizon"], params["points_per_sec"]*params["horizon"] + 1)
+    ts = np.arange(0, params["horizon"] + dt, dt)
+    controller_steps = [j for j in range(len(ts)) if j % params["controller_stride"] == 0]
+
+    with timer.phase("spline"):
+        pos_d, vel_d, _ = sample_spline(task_adj[:, :num_points], task_adj[:, num_points:], ts[controller_steps], times=output_times, init_pos=x0)
+        task_cost = Tracking_cost(tasks, params, x0)
+
+    controller_index = {j: c for c, j in enumerate(controller_steps)}
+    input_weight = float(params["input_weight"])
+
+    # Everything the gradient flows to is an explicit input, reentrant checkpointing does not backpropagate into captured tensors
+    def unroll(x, u, pos_d, vel_d, gains, start, stop):
+        loss = torch.zeros((), dtype=torch.double)
+
+        if step_fn is not None:
+            p_d = pos_d[:, 0]
+            v_d = vel_d[:, 0]
+            target = task_cost.targets[:, start]
+            weight = task_cost.weights[start]
+            for j in range(start, stop):
+                update_u = (j % params["controller_stride"] == 0)
+                loss_step = (j % params["loss_stride"] == 0)
+                if update_u:
+                    p_d = pos_d[:, controller_index[j]]
+                    v_d = vel_d[:, controller_index[j]]
+                if loss_step:
+                    target = task_cost.targets[:, j]
+                    weight = task_cost.weights[j]
+
+                x, u, cost = step_fn(x, u, p_d, v_d, gains, residuals[:, j], target, weight, update_u, loss_step, input_weight, float(dt))
+
+                if loss_step:
+                    loss += cost.sum()
+
+            return x, u, loss
+
+        controller = batch_controllers[params["env"]](gains)
+        for j in range(start, stop):
+            if (j % params["controller_stride"] == 0):
+                c = controller_index[j]
+                u = controller.control(pos_d[:, c], vel_d[:, c], x)
+
+            if (j % params["loss_stride"] == 0):
+                loss += task_cost.step(x, u, j).sum()
+
+            x = f_nominal(x, u, dt) + residuals[:, j]
+
+        return x, u, loss
+
+    u = torch.zeros(len(x0), action_dims[params["env"]], dtype=torch.double)
+
+    if not checkpoint_chunk:
+        return unroll(x0, u, pos_d, vel_d, gains, 0, len(ts))[2]
+
+    # Runs without grad while the loss is built and again with grad when recomputed during backward
+    def unroll_chunk(*args):
+        if meter is not None and torch.is_grad_enabled():
+            with meter.chunk():
+                return unroll(*args)
+        return unroll(*args)
+
+    # Only the chunk boundaries stay in the graph, every chunk is recomputed during backward
+    x = x0
+    loss = 0
+    for start in range(0, len(ts), checkpoint_chunk):
+        x, u, chunk_loss = checkpoint(unroll_chunk, x, u, pos_d, vel_d, gains, start, min(start + checkpoint_chunk, len(ts)), **checkpoint_kwargs)
+        loss = loss + chunk_loss
+
+    return loss